@@ -4,11 +4,16 @@ This script was adapted from the one in http://bamos.github.io/2014/07/05/music-
 
 import argparse
 import glob
+import json
 import os
+import queue
 import re
 import shutil
 import sys
 import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import mutagen
 from mutagen.easyid3 import EasyID3
 
 
@@ -48,32 +53,68 @@ def try_easyid3(filename):
     return (artist, title)
 
 
-def try_ffmpeg(filename):
-    result = subprocess.run(['ffmpeg', '-i', filename, '-hide_banner'], capture_output=True)
+# Tags of formats other than mp3 are read the way ffmpeg prints them: lowercase, with spaces, '*' and '_' collapsed
+def ffmpeg_style(value):
+    return re.sub(r"[ \*\_]+", " ", value.lower().strip())
+
+
+def try_mutagen(filename):
+    try:
+        audio = mutagen.File(filename, easy=True)
+        artist = ffmpeg_style(audio['artist'][0])
+        title = ffmpeg_style(audio['title'][0])
+    except:
+        artist = None
+        title = None
+    return (artist, title)
+
+
+def try_ffprobe(filename):
+    result = subprocess.run(['ffprobe', '-v', 'quiet', '-print_format', 'json', '-show_format', '-show_streams',
+                             filename], capture_output=True)
+    try:
+        info = json.loads(result.stdout.decode("utf-8"))
+    except ValueError:
+        return (None, None)
     artist = None
     title = None
-    for line in result.stderr.decode("utf-8").split("\n"):
-        line = line.lower().strip()
-        line = re.sub(r"[ \*\_]+", " ", line)
-        if artist is None and line.startswith('artist : '):
-            artist = line.split("artist : ")[1]
-        elif title is None and line.startswith('title : '):
-            title = line.split("title : ")[1]
+    # Tags of the file first, then of each stream, in the order ffmpeg prints them
+    for tags in [info.get('format', {}).get('tags', {})] + [s.get('tags', {}) for s in info.get('streams', [])]:
+        tags = {key.lower(): value for key, value in tags.items()}
+        if artist is None and 'artist' in tags:
+            artist = ffmpeg_style(tags['artist'])
+        if title is None and 'title' in tags:
+            title = ffmpeg_style(tags['title'])
+    return (artist, title)
+
+
+# Extracts (artist, title) from a song, or None for dotfiles, which are ignored
+def song_tags(filename):
+    if filename[0] == '.':
+        return None
+    # For all mp3s
+    (artist, title) = try_easyid3(filename)
+    # For other files mutagen can read (flac, ogg, m4a, ...)
+    if artist is None:
+        (artist, title) = try_mutagen(filename)
+    # For anything else ffmpeg can read
+    if artist is None:
+        (artist, title) = try_ffprobe(filename)
     return (artist, title)
-    
 
 
 # Extracts information from filename, moves the song to targetDir, prints if verbose
 def song(filename, targetDir, verbose):
-    if filename[0] == '.':
+    move_song(filename, song_tags(filename), targetDir, verbose)
+
+
+# Moves the song to targetDir given its tags (as returned by song_tags), prints if verbose
+def move_song(filename, tags, targetDir, verbose):
+    if tags is None:
         print("Ignoring dotfile: '{}'".format(filename))
         return
     ext = os.path.splitext(filename)[1]
-    # For all mp3s
-    (artist, title) = try_easyid3(filename)
-    # For other files
-    if artist is None:
-        (artist, title) = try_ffmpeg(filename)
+    (artist, title) = tags
     # If not found
     if artist is None or title is None:
         print("ERROR: " + filename + " with missing artist or title")
@@ -92,6 +133,43 @@ def song(filename, targetDir, verbose):
     os.rename(filename, newFullPath)
 
 
+# Organizes every file in fromDir into targetDir, in three stages: files are listed into a bounded queue,
+# 'jobs' threads extract their tags, and a single thread moves them in the order they were listed,
+# so the output is the same as moving them one at a time
+def organize(fromDir, targetDir, verbose, jobs=1):
+    pending = queue.Queue(maxsize=4 * jobs)
+    errors = []
+
+    def mover():
+        while True:
+            item = pending.get()
+            if item is None:
+                return
+            # after an error, the queue is only emptied
+            if len(errors) > 0:
+                continue
+            (filename, tags) = item
+            try:
+                move_song(filename, tags.result(), targetDir, verbose)
+            except BaseException as e:
+                errors.append(e)
+
+    with ThreadPoolExecutor(jobs) as executor:
+        moverThread = threading.Thread(target=mover)
+        moverThread.start()
+        # files are all listed before any is moved, so moves never change which files are found
+        for f in glob.glob(fromDir + "/**", recursive=True):
+            if len(errors) > 0:
+                break
+            if not os.path.isfile(f):
+                continue
+            pending.put((f, executor.submit(song_tags, f)))
+        pending.put(None)
+        moverThread.join()
+    if len(errors) > 0:
+        raise errors[0]
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         description='''Organizes a music collection using tag information.
@@ -106,12 +184,11 @@ if __name__ == "__main__":
                         help='''Target folder with organized songs''')
     parser.add_argument('--verbose', action='store_true', dest='verbose',
                         help='''Whether to print all info''')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(), dest='jobs',
+                        help='''Amount of songs whose tags are read in parallel (default: amount of CPUs)''')
     args = parser.parse_args()
 
     if not os.path.isdir(args.to_dir):
         os.mkdir(args.to_dir)
-    for f in glob.glob(args.from_dir + "/**", recursive=True):
-        if not os.path.isfile(f):
-            continue
-        song(f, args.to_dir, args.verbose)
+    organize(args.from_dir, args.to_dir, args.verbose, max(1, args.jobs))
     print("Complete!")
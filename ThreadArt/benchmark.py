@@ -0,0 +1,388 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Benchmarks of the line search
+"""
+
+import contextlib
+import io
+import json
+import platform
+import shutil
+import sys
+import tempfile
+import tracemalloc
+
+from generate import *
+
+
+def time_find_lines(engine, image, weights, params, seed=0):
+    """
+    Draws lines over a copy of 'image' with a fixed seed. Returns the lines and the seconds it took.
+    """
+    np.random.seed(seed)
+    with contextlib.redirect_stdout(io.StringIO()):
+        state = SearchState.new(image, engine.n_hooks)
+        t0 = time.time()
+        engine.run(image, weights, params, state=state)
+    return state.list_of_lines, time.time() - t0
+
+
+def benchmark_workers(src_file, hooks_list, line_w_list, workers_list, n_lines, cache_dir="cache"):
+    """
+    Measures how parallel scoring ('find_lines' with 'workers') scales with the amount of hooks and the wheel
+    resolution. Every amount of workers must draw the same lines as 1 worker.
+    Returns a row per (hooks, line width, workers).
+    """
+    rows = []
+    for n_hooks, line_w_milim in product(hooks_list, line_w_list):
+        wheel_p = int(1 / (line_w_milim / 1000))
+        engine = ThreadArtEngine.load(n_hooks, wheel_p, cache_dir)
+        image, weights = engine.prepare(src_file)
+        n_lines_run = min(n_lines, int((n_hooks-1)*(n_hooks/2)))
+
+        serial_lines, serial_time = None, None
+        for workers in workers_list:
+            lines, seconds = time_find_lines(engine, image, weights, {"n_lines": n_lines_run, "workers": workers})
+            if serial_lines is None:
+                serial_lines, serial_time = lines, seconds
+            rows.append({"hooks": n_hooks, "wheel_p": wheel_p, "workers": workers,
+                         "lines_per_s": round((len(lines) - 1) / seconds, 1),
+                         "speedup": round(serial_time / seconds, 2), "same_lines": lines == serial_lines})
+            print(f"hooks = {n_hooks}, wheel = {wheel_p}px, workers = {workers}: "
+                  f"{rows[-1]['lines_per_s']} lines/s, speedup = {rows[-1]['speedup']}, "
+                  f"same lines = {rows[-1]['same_lines']}")
+    return rows
+
+
+# images of the suite: name, source, weighted image, and wpos/wneg images, relative to this folder
+# ("gradient" is generated)
+SUITE_CASES = [
+    ("gray", "gray.jpg", None, None, None),
+    ("gradient", None, None, None, None),
+    ("example_weighted", "example.jpg", "example_weighted.jpg", None, None),
+    ("joker_dual_weighted", "joker.jpg", None, "joker_wpos.jpg", "joker_wneg.jpg"),
+]
+
+
+def save_gradient(file_name, size=600):
+    """
+    Saves a synthetic image with a diagonal gradient and a dark disk, so the suite does not only depend on
+    photos.
+    """
+    coords = np.arange(size) / size
+    image = 255 * (coords[:, None] + coords[None, :]) / 2
+    image[(coords[:, None] - 0.6) ** 2 + (coords[None, :] - 0.4) ** 2 < 0.04] *= 0.2
+    Image.fromarray(image.astype(np.uint8)).save(file_name)
+
+
+def measure(function, repeat=1, memory=True):
+    """
+    Calls 'function' 'repeat' times, and once more tracing memory if 'memory' is True (tracing slows it
+    down, so that call is not timed).
+    Returns the result of the last call, its fastest time in seconds, and its peak of memory allocated in MB
+    (or None).
+    """
+    seconds = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = function()
+        seconds.append(time.perf_counter() - t0)
+
+    peak_mb = None
+    if memory:
+        tracemalloc.start()
+        with contextlib.redirect_stdout(io.StringIO()):
+            function()
+        peak_mb = round(tracemalloc.get_traced_memory()[1] / 2 ** 20, 1)
+        tracemalloc.stop()
+    return result, round(min(seconds), 4), peak_mb
+
+
+def benchmark_suite(hooks_list, line_w_list, n_lines, repeat=1, seed=0, memory=True, cache_dir="cache"):
+    """
+    Times each phase of drawing portraits, over every image of SUITE_CASES (covering unweighted, weighted and
+    dual-weighted penalties) and every amount of hooks and line width, with a fixed seed.
+    Phases are building the line pixels and loading them from the cache (once per geometry), preparing the
+    images, drawing 'n_lines' lines, and saving the outputs. Each phase gets its fastest time of 'repeat'
+    and its peak of memory allocated.
+    Returns the results as a dict, along with a description of the machine.
+    """
+    work_dir = tempfile.mkdtemp()
+    here = os.path.dirname(os.path.abspath(__file__))
+    results = {"machine": {"python": platform.python_version(), "numpy": np.__version__,
+                           "platform": platform.platform(), "cpus": os.cpu_count()},
+               "settings": {"hooks": hooks_list, "line_w": line_w_list, "lines": n_lines, "repeat": repeat,
+                            "seed": seed},
+               "geometry": [], "runs": []}
+    try:
+        gradient_file = os.path.join(work_dir, "gradient.png")
+        save_gradient(gradient_file)
+
+        for n_hooks, line_w_milim in product(hooks_list, line_w_list):
+            wheel_p = int(1 / (line_w_milim / 1000))
+            _, build_s, build_mb = measure(
+                lambda: build_line_pixels(generate_hooks(n_hooks, wheel_p), n_hooks, wheel_p), repeat, memory)
+            with contextlib.redirect_stdout(io.StringIO()):
+                load_geometry(n_hooks, wheel_p, cache_dir)
+            engine, load_s, _ = measure(lambda: ThreadArtEngine.load(n_hooks, wheel_p, cache_dir), repeat, False)
+            results["geometry"].append({"hooks": n_hooks, "wheel_p": wheel_p, "build_s": build_s,
+                                        "build_peak_mb": build_mb, "load_s": load_s,
+                                        "line_pixels_mb": round(engine.line_pixels.nbytes / 2 ** 20, 1)})
+            print(f"hooks = {n_hooks}, wheel = {wheel_p}px: build = {build_s}s, load = {load_s}s")
+
+            for name, src, weighted, wpos, wneg in SUITE_CASES:
+                files = [gradient_file if src is None else os.path.join(here, src)] + \
+                    [None if f is None else os.path.join(here, f) for f in [weighted, wpos, wneg]]
+                n_lines_run = min(n_lines, int((n_hooks-1)*(n_hooks/2)))
+
+                def draw():
+                    np.random.seed(seed)
+                    return engine.run(image, weights, {"n_lines": n_lines_run})
+
+                (image, weights), prepare_s, prepare_mb = measure(lambda: engine.prepare(*files), repeat, memory)
+                state, draw_s, draw_mb = measure(draw, repeat, memory)
+                out_file = os.path.join(work_dir, "out")
+                _, save_s, save_mb = measure(lambda: engine.save_outputs(state, out_file, 0.54), repeat, memory)
+                results["runs"].append({
+                    "case": name, "hooks": n_hooks, "wheel_p": wheel_p, "lines": len(state.list_of_lines) - 1,
+                    "prepare_s": prepare_s, "prepare_peak_mb": prepare_mb,
+                    "find_lines_s": draw_s, "find_lines_peak_mb": draw_mb,
+                    "lines_per_s": round((len(state.list_of_lines) - 1) / draw_s, 1),
+                    "save_s": save_s, "save_peak_mb": save_mb,
+                    "avg_penalty": round(state.penalty / wheel_p ** 2, 6)})
+                print(f"  {name}: prepare = {prepare_s}s, find_lines = {draw_s}s "
+                      f"({results['runs'][-1]['lines_per_s']} lines/s), save = {save_s}s")
+    finally:
+        shutil.rmtree(work_dir)
+    return results
+
+
+# relative fitness difference under which "single" precision can pick either of two lines (float32 weights have
+# a relative rounding error of 6e-8, summed over every pixel of a line)
+FLOAT32_TIE = 1e-6
+
+
+def fitness_gap(engine, image, weights, lines, step, other_line, darkness, lightness_penalty):
+    """
+    Relative difference between the fitness of line 'step' of 'lines' and of 'other_line', in the image left
+    after drawing the lines before it, measured in "double" precision.
+    """
+    image_flat = image.astype(np.float64).reshape(-1)
+    for line in lines[1:step]:
+        image_flat[engine.line_pixels[line]] -= darkness
+    flat_weights = {name: weight.reshape(-1) for name, weight in weights.items()}
+    line_norm_mode = LineNormalization.LENGTH if len(weights) == 0 else LineNormalization.WEIGHTED_LENGTH
+    best, other = [fitness(engine.line_pixels, image_flat, line, darkness, lightness_penalty,
+                           flat_weights.get("w"), flat_weights.get("w_pos"), flat_weights.get("w_neg"),
+                           line_norm_mode) for line in [lines[step], other_line]]
+    return abs(best - other) / abs(best)
+
+
+def first_difference(lines, reference):
+    """
+    Index of the first line that differs between two lists of lines (including one list being longer), or
+    None if they are the same.
+    """
+    if lines == reference:
+        return None
+    return next(i for i, (a, b) in enumerate(zip(lines + [None], reference + [None])) if a != b)
+
+
+def continue_lines(engine, image, weights, lines, n_lines):
+    """
+    Draws 'lines' (a list of lines starting with the starting hook) over a copy of 'image', and continues the
+    run from there with 'engine' up to 'n_lines' lines. Returns all the lines.
+    """
+    image = image.copy()
+    image_flat = image.reshape(-1)
+    for line in lines[1:]:
+        image_flat[engine.line_pixels[line]] -= DEFAULT_PARAMS["darkness"]
+    state = SearchState(image, [list(line) for line in lines])
+    with contextlib.redirect_stdout(io.StringIO()):
+        engine.run(None, weights, {"n_lines": n_lines}, state=state)
+    return state.list_of_lines
+
+
+def check_precision(hooks_list, line_w_list, n_lines, seed=0, cache_dir="cache"):
+    """
+    Checks that the "single" and "compact" precisions (see 'prepare_image') draw the same lines as "double",
+    over the bundled images of SUITE_CASES (covering unweighted, weighted and dual-weighted penalties) and
+    every amount of hooks and line width, with a fixed seed.
+    "compact" weights are exact, so they should always match. "single" weights are rounded to float32, which
+    can change the order of lines whose fitness is tied (or differs by less than float32 rounding): this is
+    expected on some images (e.g. joker.jpg, dual-weighted, at 180 hooks). Such a difference is only accepted
+    if both lines are within FLOAT32_TIE of each other in "double" precision, and the run then continues from
+    the line "double" picked (see 'continue_lines'), so every later line is still checked.
+    Prints the first differing line of every mismatch, and returns the list of mismatches.
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    mismatches = []
+    for n_hooks, line_w_milim in product(hooks_list, line_w_list):
+        wheel_p = int(1 / (line_w_milim / 1000))
+        with contextlib.redirect_stdout(io.StringIO()):
+            engine = ThreadArtEngine.load(n_hooks, wheel_p, cache_dir)
+        n_lines_run = min(n_lines, int((n_hooks-1)*(n_hooks/2)))
+        for name, src, weighted, wpos, wneg in SUITE_CASES:
+            if src is None:
+                continue
+            files = [os.path.join(here, src)] + [None if f is None else os.path.join(here, f)
+                                                 for f in [weighted, wpos, wneg]]
+            reference, double_image, double_weights = None, None, None
+            for precision in ["double", "single", "compact"]:
+                precision_engine = ThreadArtEngine(engine.hooks, engine.line_pixels, precision)
+                image, weights = precision_engine.prepare(*files)
+                lines, _ = time_find_lines(precision_engine, image, weights, {"n_lines": n_lines_run}, seed)
+                if reference is None:
+                    reference, double_image, double_weights = lines, image, weights
+                    continue
+                label = f"{name}, {n_hooks} hooks, {wheel_p}px, {precision}"
+                ties = []
+                step = first_difference(lines, reference)
+                while precision == "single" and step is not None and 0 < step < min(len(lines), len(reference)):
+                    gap = fitness_gap(engine, double_image, double_weights, reference, step, lines[step],
+                                      DEFAULT_PARAMS["darkness"], DEFAULT_PARAMS["lightness_penalty"])
+                    if gap >= FLOAT32_TIE:
+                        break
+                    ties.append(step)
+                    lines = continue_lines(precision_engine, image, weights, reference[:step + 1], n_lines_run)
+                    step = first_difference(lines, reference)
+                if step is None:
+                    print(f"{label}: same lines" + (f" (following double at {len(ties)} tied lines, the first "
+                                                    f"one being line {ties[0]})" if len(ties) > 0 else ""))
+                    continue
+                mismatches.append(label)
+                print(f"MISMATCH {label}: line {step} is {lines[step] if step < len(lines) else None} "
+                      f"instead of {reference[step] if step < len(reference) else None}")
+    print(f"{len(mismatches)} mismatches")
+    return mismatches
+
+
+def compare_results(baseline, results, threshold=0.1, min_change=0.01):
+    """
+    Compares two results of 'benchmark_suite', matching geometries and runs by their images, hooks and wheel
+    size. Times and peaks of memory more than 'threshold' (a fraction) above the baseline are regressions,
+    unless they changed by less than 'min_change' (seconds or MB), which is only noise for the fastest phases.
+    Runs whose final penalty changed are regressions too, since with the same seed they should draw the
+    same lines.
+    Prints every change above the threshold, and returns the list of regressions.
+    """
+    regressions = []
+
+    def check(label, old, new, lower_is_better=True):
+        if old is None or new is None or old == 0 or abs(new - old) < min_change:
+            return
+        ratio = new / old if lower_is_better else old / new
+        if ratio > 1 + threshold:
+            regressions.append(f"{label}: {old} -> {new}")
+            print(f"REGRESSION {label}: {old} -> {new} ({100 * (ratio - 1):+.0f}%)")
+        elif ratio < 1 / (1 + threshold):
+            print(f"improvement {label}: {old} -> {new} ({100 * (ratio - 1):+.0f}%)")
+
+    for key, metrics in [("geometry", ["build_s", "build_peak_mb", "load_s", "line_pixels_mb"]),
+                         ("runs", ["prepare_s", "prepare_peak_mb", "find_lines_s", "find_lines_peak_mb",
+                                   "save_s", "save_peak_mb"])]:
+        old_rows = {(row.get("case"), row["hooks"], row["wheel_p"]): row for row in baseline[key]}
+        for row in results[key]:
+            row_key = (row.get("case"), row["hooks"], row["wheel_p"])
+            if row_key not in old_rows:
+                continue
+            old = old_rows[row_key]
+            label = ", ".join(str(part) for part in row_key if part is not None)
+            for metric in metrics:
+                check(f"{label}, {metric}", old.get(metric), row.get(metric))
+            if key == "runs" and not np.isclose(old["avg_penalty"], row["avg_penalty"], rtol=1e-6):
+                regressions.append(f"{label}, avg_penalty: {old['avg_penalty']} -> {row['avg_penalty']}")
+                print(f"CHANGED {label}, avg_penalty: {old['avg_penalty']} -> {row['avg_penalty']}")
+
+    print(f"{len(regressions)} regressions")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='''Benchmarks of the line search.'''
+    )
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    parser_w = subparsers.add_parser('workers', help='''How parallel scoring (generate.py --workers) scales with \
+        the amount of hooks and the wheel resolution''')
+    parser_w.add_argument('--src', default="example.jpg", dest='src',
+                          help='''Source file (default: example.jpg)''')
+    parser_w.add_argument('--hooks', type=int, nargs='+', default=[180, 360], dest='hooks',
+                          help='''Amounts of hooks (default: 180 360)''')
+    parser_w.add_argument('--line_w', type=float, nargs='+', default=[1.0, 0.7, 0.4], dest='line_w',
+                          help='''Line widths (in milimeters), setting the wheel resolution (default: 1.0 0.7 0.4)''')
+    parser_w.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8], dest='workers',
+                          help='''Amounts of threads, the first one being the reference (default: 1 2 4 8)''')
+    parser_w.add_argument('--lines', type=int, default=300, dest='lines',
+                          help='''Amount of lines drawn per run (default: 300)''')
+    parser_w.add_argument('--cache_dir', default="cache", dest='cache_dir',
+                          help='''Folder where hooks and line pixels are cached between runs (default: cache)''')
+    parser_s = subparsers.add_parser('suite', help='''Times each phase (line pixels, images, line search, outputs) \
+        over bundled and synthetic images, and saves the results as JSON''')
+    parser_s.add_argument('--out', default="benchmark.json", dest='out',
+                          help='''JSON file to save the results into (default: benchmark.json)''')
+    parser_s.add_argument('--hooks', type=int, nargs='+', default=[180, 360], dest='hooks',
+                          help='''Amounts of hooks (default: 180 360)''')
+    parser_s.add_argument('--line_w', type=float, nargs='+', default=[1.0, 0.7], dest='line_w',
+                          help='''Line widths (in milimeters), setting the wheel resolution (default: 1.0 0.7)''')
+    parser_s.add_argument('--lines', type=int, default=300, dest='lines',
+                          help='''Amount of lines drawn per run (default: 300)''')
+    parser_s.add_argument('--repeat', type=int, default=3, dest='repeat',
+                          help='''Amount of times each phase is timed, keeping the fastest (default: 3)''')
+    parser_s.add_argument('--seed', type=int, default=0, dest='seed',
+                          help='''Random seed of the runs (default: 0)''')
+    parser_s.add_argument('--no_memory', action='store_true', dest='no_memory',
+                          help='''Whether to skip measuring peak memory, which runs each phase once more''')
+    parser_s.add_argument('--cache_dir', default="cache", dest='cache_dir',
+                          help='''Folder where hooks and line pixels are cached between runs (default: cache)''')
+    parser_c = subparsers.add_parser('compare', help='''Compares suite results with a baseline, flagging \
+        regressions (exits with 1 if there are any)''')
+    parser_c.add_argument('baseline', help='''JSON results of the baseline''')
+    parser_c.add_argument('results', help='''JSON results to compare''')
+    parser_c.add_argument('--threshold', type=float, default=0.1, dest='threshold',
+                          help='''Fraction above the baseline from which a time or memory peak is a regression (default: 0.1)''')
+    parser_c.add_argument('--min_change', type=float, default=0.01, dest='min_change',
+                          help='''Smallest change (in seconds or MB) that can be a regression (default: 0.01)''')
+    parser_p = subparsers.add_parser('precision', help='''Checks that --precision single and compact draw the \
+        same lines as double on the bundled images (exits with 1 if they do not)''')
+    parser_p.add_argument('--hooks', type=int, nargs='+', default=[180], dest='hooks',
+                          help='''Amounts of hooks (default: 180)''')
+    parser_p.add_argument('--line_w', type=float, nargs='+', default=[1.4], dest='line_w',
+                          help='''Line widths (in milimeters), setting the wheel resolution (default: 1.4)''')
+    parser_p.add_argument('--lines', type=int, default=1500, dest='lines',
+                          help='''Amount of lines drawn per run (default: 1500)''')
+    parser_p.add_argument('--seed', type=int, default=0, dest='seed',
+                          help='''Random seed of the runs (default: 0)''')
+    parser_p.add_argument('--cache_dir', default="cache", dest='cache_dir',
+                          help='''Folder where hooks and line pixels are cached between runs (default: cache)''')
+    args = parser.parse_args()
+
+    if args.command == 'workers':
+        if file_path_invalid(args.src):
+            exit(0)
+        benchmark_workers(args.src, [max(3, n_hooks) for n_hooks in args.hooks],
+                          [max(0.01, line_w) for line_w in args.line_w], [max(1, w) for w in args.workers],
+                          max(1, args.lines), args.cache_dir)
+    elif args.command == 'suite':
+        results = benchmark_suite([max(3, n_hooks) for n_hooks in args.hooks],
+                                  [max(0.01, line_w) for line_w in args.line_w], max(1, args.lines),
+                                  max(1, args.repeat), args.seed, not args.no_memory, args.cache_dir)
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+        print("results saved to " + args.out)
+    elif args.command == 'compare':
+        if file_path_invalid(args.baseline) or file_path_invalid(args.results):
+            exit(0)
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        with open(args.results) as f:
+            results = json.load(f)
+        sys.exit(1 if len(compare_results(baseline, results, max(0, args.threshold), max(0, args.min_change))) > 0
+                 else 0)
+    elif args.command == 'precision':
+        sys.exit(1 if len(check_precision([max(3, n_hooks) for n_hooks in args.hooks],
+                                          [max(0.01, line_w) for line_w in args.line_w], max(1, args.lines),
+                                          args.seed, args.cache_dir)) > 0 else 0)
@@ -12,11 +12,14 @@ import matplotlib.pyplot as plt
 import time
 import argparse
 import os
+from collections import deque
+import contextlib
+from multiprocessing import Pool
 
 from utils import *
 
 
-def fitness(through_pixels_dict, image, line, darkness, lp, w, w_pos, w_neg, line_norm_mode):
+def fitness(line_pixels, image, line, darkness, lp, w, w_pos, w_neg, line_norm_mode):
     """
     Measures how much a line improves the image.
     Improvement is difference in penalty between the old and new images (i.e. a large decrease
@@ -37,9 +40,9 @@ def fitness(through_pixels_dict, image, line, darkness, lp, w, w_pos, w_neg, lin
         pixels where penalty is worth more than others. Basically, a map of where lines must not be added
     @param line_norm_mode ?
     """
-    pixels = through_pixels_dict[tuple(sorted(line))]
+    pixels = line_pixels[line]
 
-    old_pixel_values = image[tuple(pixels.T)]
+    old_pixel_values = np.take(image, pixels)
     new_pixel_values = old_pixel_values - darkness
 
     if w is None and w_pos is None:
@@ -48,7 +51,7 @@ def fitness(through_pixels_dict, image, line, darkness, lp, w, w_pos, w_neg, lin
         old_penalty = old_pixel_values.sum() - (1 + lp) * \
             old_pixel_values[old_pixel_values < 0].sum()
     elif w_pos is None:
-        pixel_weightings = w[tuple(pixels.T)]
+        pixel_weightings = weight_values(w, pixels)
         new_w_pixel_values = new_pixel_values * pixel_weightings
         old_w_pixel_values = old_pixel_values * pixel_weightings
         new_penalty = new_w_pixel_values.sum() - (1 + lp) * \
@@ -56,8 +59,8 @@ def fitness(through_pixels_dict, image, line, darkness, lp, w, w_pos, w_neg, lin
         old_penalty = old_w_pixel_values.sum() - (1 + lp) * \
             old_w_pixel_values[old_pixel_values < 0].sum()
     elif w is None:
-        pos_pixel_weightings = w_pos[tuple(pixels.T)]
-        neg_pixel_weightings = w_neg[tuple(pixels.T)]
+        pos_pixel_weightings = weight_values(w_pos, pixels)
+        neg_pixel_weightings = weight_values(w_neg, pixels)
         new_wpos_pixel_values = new_pixel_values * pos_pixel_weightings
         new_wneg_pixel_values = new_pixel_values * neg_pixel_weightings
         old_wpos_pixel_values = old_pixel_values * pos_pixel_weightings
@@ -83,16 +86,442 @@ def fitness(through_pixels_dict, image, line, darkness, lp, w, w_pos, w_neg, lin
         return (old_penalty - new_penalty) / line_norm
 
 
-def optimise_fitness(through_pixels_dict, n_hooks, image, previous_edge, darkness,
+def pixel_fitness(old_pixel_values, darkness, lp, pixel_weightings, pos_pixel_weightings, neg_pixel_weightings):
+    """
+    Decrease in penalty of each pixel when a line of 'darkness' goes through it (see 'fitness').
+    The weightings are the weighted images gathered at the same pixels, or None.
+    """
+    if old_pixel_values.dtype == np.int16:
+        # compact images would wrap around below -32768 when the line is subtracted
+        old_pixel_values = old_pixel_values.astype(np.int32)
+    new_pixel_values = old_pixel_values - darkness
+
+    if pixel_weightings is None and pos_pixel_weightings is None:
+        old_penalty = old_pixel_values - (1 + lp) * np.minimum(old_pixel_values, 0)
+        new_penalty = new_pixel_values - (1 + lp) * np.minimum(new_pixel_values, 0)
+    elif pos_pixel_weightings is None:
+        old_penalty = old_pixel_values * pixel_weightings
+        old_penalty[old_pixel_values < 0] *= -lp
+        new_penalty = new_pixel_values * pixel_weightings
+        new_penalty[new_pixel_values < 0] *= -lp
+    elif pixel_weightings is None:
+        old_penalty = np.where(old_pixel_values > 0, old_pixel_values * pos_pixel_weightings,
+                               -lp * np.minimum(old_pixel_values, 0) * neg_pixel_weightings)
+        new_penalty = np.where(new_pixel_values > 0, new_pixel_values * pos_pixel_weightings,
+                               -lp * np.minimum(new_pixel_values, 0) * neg_pixel_weightings)
+
+    return old_penalty - new_penalty
+
+
+def line_norms(starts, n_pixels, pixel_weightings, pos_pixel_weightings, line_norm_mode):
+    """
+    Normalization of several packed lines (see 'batch_fitness'), according to 'line_norm_mode'.
+    """
+    if line_norm_mode == LineNormalization.LENGTH:
+        return np.diff(np.append(starts, n_pixels))
+    elif line_norm_mode == LineNormalization.WEIGHTED_LENGTH:
+        if pos_pixel_weightings is None:
+            return np.add.reduceat(pixel_weightings, starts, dtype=np.float64)
+        else:
+            return np.add.reduceat(pos_pixel_weightings, starts, dtype=np.float64)
+    elif line_norm_mode == LineNormalization.NONE:
+        return np.ones(len(starts))
+
+
+def batch_fitness(image, pixels, starts, darkness, lp, w, w_pos, w_neg, line_norm_mode):
+    """
+    Vectorized version of 'fitness', which scores several lines at once.
+    The pixels of all lines are packed into a single buffer of linear pixel indices ('pixels'), and
+    'starts' holds the index where each line begins in that buffer. The per-pixel penalty differences
+    are then summed per line with 'np.add.reduceat', always in float64 whatever the precision of the images.
+    'fitness' subtracts two separate sums instead, so values can differ in their last bits, and lines whose
+    fitness only differs there (near-ties) can be picked in another order than with 'fitness'.
+
+    @param image flattened image (see 'fitness')
+    @param pixels linear indices of the pixels of all lines, one line after the other
+    @param starts index in 'pixels' where each line starts
+    @param w, w_pos, w_neg flattened weighted images, or None (see 'fitness')
+    Returns an array with the fitness of each line.
+    """
+    pixel_weightings = weight_values(w, pixels)
+    pos_pixel_weightings = weight_values(w_pos, pixels)
+    neg_pixel_weightings = weight_values(w_neg, pixels)
+
+    improvement = np.add.reduceat(pixel_fitness(image[pixels], darkness, lp, pixel_weightings,
+                                                pos_pixel_weightings, neg_pixel_weightings),
+                                  starts, dtype=np.float64)
+    line_norm = line_norms(starts, len(pixels), pixel_weightings, pos_pixel_weightings, line_norm_mode)
+
+    # lines with a norm of 0 have a fitness of 0
+    safe_norm = np.where(line_norm == 0, 1, line_norm)
+    return np.where(line_norm == 0, 0, improvement / safe_norm)
+
+
+class LineConstants:
+    """
+    Per line values that only depend on the weighted images, which never change during a run, so they are
+    computed once per image instead of at every step.
+    The norm of each line is computed the first time it is scored (weighted norms need the weightings of the
+    line, which are gathered then anyway) and kept for the rest of the run.
+    If 'gather_weights' is True, the weightings of every line pixel are also gathered upfront, in the same
+    layout as the pixels of 'line_pixels', so scoring only needs to gather the residual image. They are kept
+    in the dtype of the weighted images, so each one takes as much memory as the line pixels in "single"
+    precision.
+    All images must be flattened.
+    """
+
+    def __init__(self, line_pixels, w, w_pos, w_neg, line_norm_mode, gather_weights=False):
+        self.line_pixels = line_pixels
+        self.w = w
+        self.w_pos = w_pos
+        self.w_neg = w_neg
+        self.gathered = gather_weights
+
+        self.line_norm_mode = line_norm_mode
+
+        lengths = np.diff(line_pixels.offsets)
+        if line_norm_mode == LineNormalization.LENGTH:
+            self.norm = lengths.astype(np.float64)
+        elif line_norm_mode == LineNormalization.NONE:
+            self.norm = np.ones(len(lengths))
+        else:
+            # NaN until the line is first scored
+            self.norm = np.full(len(lengths), np.nan)
+
+        if gather_weights:
+            self.w = None if w is None else np.take(w, line_pixels.pixels)
+            self.w_pos = None if w_pos is None else np.take(w_pos, line_pixels.pixels)
+            self.w_neg = None if w_neg is None else np.take(w_neg, line_pixels.pixels)
+
+    def fitness(self, image, pair_ids, darkness, lp):
+        """
+        Same as 'batch_fitness' for the lines with the given pair ids.
+        """
+        indices, starts = range_indices(self.line_pixels.offsets, pair_ids)
+        pixels = self.line_pixels.pixels[indices]
+        weights_index = indices if self.gathered else pixels
+        pixel_weightings = weight_values(self.w, weights_index)
+        pos_pixel_weightings = weight_values(self.w_pos, weights_index)
+        improvement = np.add.reduceat(pixel_fitness(image[pixels], darkness, lp, pixel_weightings,
+                                                    pos_pixel_weightings, weight_values(self.w_neg, weights_index)),
+                                      starts, dtype=np.float64)
+
+        line_norm = self.norm[pair_ids]
+        if np.isnan(line_norm).any():
+            line_norm = line_norms(starts, len(pixels), pixel_weightings, pos_pixel_weightings,
+                                   self.line_norm_mode)
+            self.norm[pair_ids] = line_norm
+        # lines with a norm of 0 have a fitness of 0
+        safe_norm = np.where(line_norm == 0, 1, line_norm)
+        return np.where(line_norm == 0, 0, improvement / safe_norm)
+
+
+class IncrementalFitness:
+    """
+    Keeps the fitness of every line cached, so 'optimise_fitness' does not need to rescore all candidates
+    against the image at every step.
+    When a line is subtracted, only its own pixels change, so the cached penalty decrease of every line
+    crossing those pixels (found through the pixel -> lines inverted index of 'line_pixels') is updated
+    with the difference. Line norms never change during a run, so they are computed only once.
+    Each update adds some floating point error, so lines updated more than 'max_updates' times are
+    marked dirty and recomputed from the image the next time they are scored.
+    All images must be flattened.
+    """
+
+    def __init__(self, line_pixels, image, darkness, lp, w, w_pos, w_neg, line_norm_mode, max_updates=5000):
+        self.line_pixels = line_pixels
+        self.darkness = darkness
+        self.lp = lp
+        self.w = w
+        self.w_pos = w_pos
+        self.w_neg = w_neg
+        self.max_updates = max_updates
+        self.pixel_lines, self.pixel_offsets = line_pixels.invert()
+
+        n_pairs = len(line_pixels.offsets) - 1
+        self.improvement = np.zeros(n_pairs)
+        self.norm = np.ones(n_pairs)
+        self.updates = np.zeros(n_pairs, dtype=np.int64)
+
+        # score all lines once, in chunks to bound the size of temporary arrays
+        lengths = np.diff(line_pixels.offsets)
+        built_pairs = np.flatnonzero(lengths)
+        for chunk in np.array_split(built_pairs, max(1, line_pixels.offsets[-1] // 2 ** 22)):
+            pixels, starts = line_pixels.gather(chunk)
+            pixel_weightings = weight_values(w, pixels)
+            pos_pixel_weightings = weight_values(w_pos, pixels)
+            self.improvement[chunk] = np.add.reduceat(
+                self._pixel_fitness(image, pixels), starts, dtype=np.float64)
+            self.norm[chunk] = line_norms(starts, len(pixels), pixel_weightings,
+                                          pos_pixel_weightings, line_norm_mode)
+
+    def _pixel_fitness(self, image, pixels):
+        return pixel_fitness(image[pixels], self.darkness, self.lp,
+                             weight_values(self.w, pixels), weight_values(self.w_pos, pixels),
+                             weight_values(self.w_neg, pixels))
+
+    def scores(self, image, pair_ids):
+        """
+        Fitness of the lines with the given pair ids, recomputing the dirty ones first.
+        """
+        dirty = pair_ids[self.updates[pair_ids] > self.max_updates]
+        if len(dirty) > 0:
+            pixels, starts = self.line_pixels.gather(dirty)
+            self.improvement[dirty] = np.add.reduceat(self._pixel_fitness(image, pixels), starts,
+                                                      dtype=np.float64)
+            self.updates[dirty] = 0
+
+        line_norm = self.norm[pair_ids]
+        # lines with a norm of 0 have a fitness of 0
+        safe_norm = np.where(line_norm == 0, 1, line_norm)
+        return np.where(line_norm == 0, 0, self.improvement[pair_ids] / safe_norm)
+
+    def subtract(self, image, pair_id):
+        """
+        Subtracts a line from the image, and updates the cached fitness of every line crossing it.
+        """
+        offsets = self.line_pixels.offsets
+        pixels = self.line_pixels.pixels[offsets[pair_id]:offsets[pair_id + 1]]
+        old_pixel_fitness = self._pixel_fitness(image, pixels)
+        image[pixels] -= self.darkness
+        pixel_changes = self._pixel_fitness(image, pixels) - old_pixel_fitness
+
+        crossing_lines, starts = gather_ranges(self.pixel_lines, self.pixel_offsets, pixels)
+        counts = np.diff(np.append(starts, len(crossing_lines)))
+        np.add.at(self.improvement, crossing_lines, np.repeat(pixel_changes, counts))
+        np.add.at(self.updates, crossing_lines, 1)
+
+
+class MultiResolution:
+    """
+    Coarse-to-fine line search. Keeps a pyramid of downsampled residual images (block means of 2x2, 4x4, ...
+    pixels), and the line pixels of each level. Candidates are all scored at the coarsest level, only the
+    best ones are rescored at each finer level, and 'optimise_fitness' picks the line among the last 'top_k'.
+    Every 'check_interval' steps all candidates are also scored at full resolution, to count how often the
+    shortlist contained the true best line.
+    The levels only depend on the image through their residual images, so their 'geometry' can be built
+    once and shared by many runs.
+    All images must be flattened, or packed with 'pack_disk' if 'disk' is given.
+    """
+
+    def __init__(self, n_hooks, wheel_pixel_size, image, w, w_pos, w_neg, darkness, lp, line_norm_mode,
+                 levels=1, top_k=10, check_interval=10, disk=None, geometry=None):
+        self.darkness = darkness
+        self.lp = lp
+        self.line_norm_mode = line_norm_mode
+        self.top_k = top_k
+        self.check_interval = check_interval
+        self.steps = 0
+        self.checks = 0
+        self.hits = 0
+
+        if geometry is None:
+            geometry = MultiResolution.geometry(n_hooks, wheel_pixel_size, levels, disk)
+        self.levels = []
+        for level in geometry:
+            def block_mean(values):
+                return None if values is None else np.bincount(
+                    level["block"], weights=weight_values(values), minlength=level["size"] ** 2) / level["factor"] ** 2
+
+            self.levels.append(dict(level, image=block_mean(image), w=block_mean(w),
+                                    w_pos=block_mean(w_pos), w_neg=block_mean(w_neg)))
+
+    @staticmethod
+    def geometry(n_hooks, wheel_pixel_size, levels, disk=None):
+        """
+        Levels of the pyramid, from finest (2x2 blocks) to coarsest: their downsampling factor and size, the
+        block of each full resolution pixel, and their line pixels.
+        """
+        geometry = []
+        for level in range(1, levels + 1):
+            factor = 2 ** level
+            size = -(-wheel_pixel_size // factor)
+            fine_pixels = np.arange(wheel_pixel_size ** 2) if disk is None else disk
+            block = (fine_pixels // wheel_pixel_size // factor) * size + fine_pixels % wheel_pixel_size // factor
+            geometry.append({"factor": factor, "size": size, "block": block,
+                             "line_pixels": build_line_pixels(generate_hooks(n_hooks, size), n_hooks, size)})
+        return geometry
+
+    def shortlist(self, pair_ids):
+        """
+        Positions (in 'pair_ids') of the lines worth scoring at full resolution.
+        """
+        candidates = np.arange(len(pair_ids))
+        for n, level in reversed(list(enumerate(self.levels))):
+            keep = self.top_k * 2 ** n
+            if len(candidates) <= keep:
+                continue
+            pixels, starts = level["line_pixels"].gather(pair_ids[candidates])
+            # a line covers about 1/factor of the area of each block it goes through
+            fitness_list = batch_fitness(level["image"], pixels, starts, self.darkness / level["factor"],
+                                         self.lp, level["w"], level["w_pos"], level["w_neg"],
+                                         self.line_norm_mode)
+            candidates = candidates[np.argsort(-fitness_list, kind="stable")[:keep]]
+
+        return np.sort(candidates)
+
+    def check_due(self):
+        self.steps += 1
+        return self.check_interval > 0 and self.steps % self.check_interval == 0
+
+    def record_check(self, hit):
+        self.checks += 1
+        self.hits += int(hit)
+
+    def subtract(self, pixels):
+        """
+        Subtracts a line (given by its full resolution pixels) from every level.
+        """
+        for level in self.levels:
+            np.subtract.at(level["image"], level["block"][pixels], self.darkness / level["factor"] ** 2)
+
+    def report(self):
+        if self.checks > 0:
+            print(f"multi-resolution: shortlist had the full resolution winner in "
+                  f"{100 * self.hits / self.checks:.1f}% of {self.checks} checked lines")
+
+
+class LineSampler:
+    """
+    Picks the candidate lines 'optimise_fitness' scores at each step, to trade some quality for speed:
+     "random", a 'fraction' of the candidates, sampled without replacement;
+     "adaptive", the same, plus the 'top_k' best lines found the last time a line was drawn from the same
+        hook, as fitness changes slowly and good lines tend to stay good.
+    The sample of each step comes from a Generator seeded with 'seed' and the amount of lines drawn so far, so
+    a run is reproducible from its seed. With the "random" policy it also is if it is stopped and continued,
+    while the best lines kept by the "adaptive" one are not saved in checkpoints.
+    Every 'check_interval' steps all candidates are also scored, to measure how often the sample contained the
+    best line, and how much of its fitness the best sampled line had.
+    """
+
+    def __init__(self, fraction, policy="random", top_k=20, seed=0, check_interval=50):
+        self.fraction = fraction
+        self.policy = policy
+        self.top_k = top_k
+        self.seed = seed
+        self.check_interval = check_interval
+        self.top = {}
+        self.steps = 0
+        self.sampled = 0
+        self.candidates = 0
+        self.checks = 0
+        self.hits = 0
+        self.fitness_ratios = []
+
+    def sample(self, step, hook, pair_ids):
+        """
+        Positions (in 'pair_ids', the candidates starting from 'hook') of the lines to score at step 'step'.
+        """
+        rng = np.random.default_rng([self.seed, step])
+        sample = rng.choice(len(pair_ids), max(1, int(len(pair_ids) * self.fraction)), replace=False)
+        if self.policy == "adaptive" and hook in self.top:
+            sample = np.union1d(sample, np.flatnonzero(np.isin(pair_ids, self.top[hook])))
+        sample = np.sort(sample)
+        self.sampled += len(sample)
+        self.candidates += len(pair_ids)
+        return sample
+
+    def record(self, hook, pair_ids, fitness_list):
+        """
+        Keeps the best lines scored from 'hook', for the "adaptive" policy.
+        """
+        if self.policy == "adaptive":
+            self.top[hook] = pair_ids[np.argsort(-fitness_list, kind="stable")[:self.top_k]]
+
+    def check_due(self):
+        self.steps += 1
+        return self.check_interval > 0 and self.steps % self.check_interval == 0
+
+    def record_check(self, best_fitness, true_best_fitness):
+        self.checks += 1
+        self.hits += int(best_fitness >= true_best_fitness)
+        # the ratio is meaningless once no line improves the image
+        if true_best_fitness > 0:
+            self.fitness_ratios.append(best_fitness / true_best_fitness)
+
+    def summary(self):
+        return {"policy": self.policy, "fraction": self.fraction, "seed": self.seed,
+                "scored": self.sampled / max(1, self.candidates), "checks": self.checks,
+                "hits": self.hits / max(1, self.checks),
+                "fitness_ratio": float(np.mean(self.fitness_ratios)) if len(self.fitness_ratios) > 0 else None}
+
+    def report(self):
+        summary = self.summary()
+        print(f"line sampling ({self.policy}): scored {100 * summary['scored']:.1f}% of candidate lines", end="")
+        if self.checks > 0:
+            print(f", the best line was sampled in {100 * summary['hits']:.1f}% of {self.checks} checked lines", end="")
+        if summary["fitness_ratio"] is not None:
+            print(f", with {100 * summary['fitness_ratio']:.1f}% of its fitness on average", end="")
+        print()
+
+
+class ParallelScorer:
+    """
+    Scores candidate lines on a pool of 'workers' threads, in one chunk of at least 'min_chunk' lines per thread.
+    Gathering pixels and the NumPy reductions of 'batch_fitness' release the GIL, so chunks run in parallel.
+    Each line is still scored on its own, so fitness values (and the best line) are the same as in one batch.
+    """
+
+    def __init__(self, workers, min_chunk=16):
+        self.workers = workers
+        self.min_chunk = min_chunk
+        self.executor = ThreadPoolExecutor(workers)
+
+    def map(self, score, pair_ids):
+        """
+        Calls 'score' on chunks of 'pair_ids', returning the concatenation of the results.
+        """
+        n_chunks = min(self.workers, len(pair_ids) // self.min_chunk)
+        if n_chunks <= 1:
+            return score(pair_ids)
+        return np.concatenate(list(self.executor.map(score, np.array_split(pair_ids, n_chunks))))
+
+    def close(self):
+        self.executor.shutdown()
+
+
+def score_lines(line_pixels, image, pair_ids, darkness, lightness_penalty, w, w_pos, w_neg, line_norm_mode,
+                incremental=None, scorer=None, constants=None):
+    """
+    Fitness of the lines with the given pair ids, scored against the (flattened) images with 'batch_fitness',
+    or with the precomputed 'constants' (a LineConstants) if given, or read from 'incremental' (an
+    IncrementalFitness) if given.
+    If 'scorer' (a ParallelScorer) is given, lines are scored in parallel threads.
+    """
+    if incremental is not None:
+        return incremental.scores(image, pair_ids)
+
+    def score(chunk):
+        if constants is not None:
+            return constants.fitness(image, chunk, darkness, lightness_penalty)
+        pixels, starts = line_pixels.gather(chunk)
+        return batch_fitness(image, pixels, starts, darkness, lightness_penalty, w, w_pos, w_neg, line_norm_mode)
+
+    return score(pair_ids) if scorer is None else scorer.map(score, pair_ids)
+
+
+def optimise_fitness(line_pixels, n_hooks, image, previous_edge, darkness,
                      lightness_penalty, list_of_lines,
-                     w, w_pos, w_neg, line_norm_mode, line_sample_fraction):
+                     w, w_pos, w_neg, line_norm_mode, line_sample_fraction, incremental=None, multires=None,
+                     min_fitness=None, scorer=None, constants=None, trace=None, sampler=None):
     """
     Process of adding a new line is as follows:
      1. Generates all possible lines starting from this hook (or a subset of lines, if you are
             using the 'line_sample_fraction' parameter).
-     2. Finds the line with the best fitness score.
+     2. Finds the line with the best fitness score (the first of exactly tied lines; near-ties can resolve
+            differently than with 'fitness', see 'batch_fitness').
      2. Subtracts this line from the image.
-     3. Returns the new image, and the best line.
+     3. Returns the new image, the best line, how much it decreased the penalty of the image, and its
+            fitness score.
+    'image' and the weighted images must be C-contiguous, so they can be flattened without copies.
+    If 'incremental' (an IncrementalFitness) is given, its cached fitness values are used instead of
+    scoring the lines against the image.
+    If 'multires' (a MultiResolution) is given, only the lines it shortlists are scored.
+    If 'scorer' (a ParallelScorer) is given, lines are scored in parallel threads.
+    If 'constants' (a LineConstants) is given, lines are scored with its precomputed norms and weightings.
+    If the best line has a fitness below 'min_fitness', nothing is subtracted and the best line is None.
+    If 'trace' (a Trace) is given, the candidates scored and the pixels read and drawn are counted into it.
+    If 'sampler' (a LineSampler) is given, it picks the lines to evaluate instead of 'line_sample_fraction'.
     """
     starting_edge = previous_edge
 
@@ -105,65 +534,341 @@ def optimise_fitness(through_pixels_dict, n_hooks, image, previous_edge, darknes
     next_lines = next_lines[mask]
 
     # randomly pick a subset of the lines to evaluate
-    if line_sample_fraction == 1:
-        next_lines = next_lines.tolist()
-    else:
-        next_lines = next_lines[np.random.choice(
-            np.arange(len(next_lines)), int(len(next_lines) * line_sample_fraction))].tolist()
+    all_pair_ids = line_pixels.pair_id(next_lines.T[0], next_lines.T[1])
+    if sampler is None and line_sample_fraction != 1:
+        sampler = LineSampler(line_sample_fraction, seed=np.random.randint(2 ** 31), check_interval=0)
+    if sampler is not None:
+        next_lines = next_lines[sampler.sample(len(list_of_lines), starting_edge, all_pair_ids)]
     # print(next_lines)
+    pair_ids = line_pixels.pair_id(next_lines.T[0], next_lines.T[1])
+
+    # evaluate all lines at once and pick best line
+    image_flat = image.reshape(-1)
+    w = None if w is None else w.reshape(-1)
+    w_pos = None if w_pos is None else w_pos.reshape(-1)
+    w_neg = None if w_neg is None else w_neg.reshape(-1)
+    candidates = np.arange(len(pair_ids)) if multires is None else multires.shortlist(pair_ids)
+    fitness_list = score_lines(line_pixels, image_flat, pair_ids[candidates], darkness, lightness_penalty,
+                               w, w_pos, w_neg, line_norm_mode, incremental, scorer, constants)
+    best_fitness = fitness_list.max()
+    best_line_idx = int(candidates[np.argmax(fitness_list)])
+    best_line = next_lines[best_line_idx].tolist()
+
+    if sampler is not None:
+        sampler.record(starting_edge, pair_ids[candidates], fitness_list)
+        if sampler.check_due():
+            sampler.record_check(best_fitness, score_lines(line_pixels, image_flat, all_pair_ids, darkness,
+                                                           lightness_penalty, w, w_pos, w_neg, line_norm_mode,
+                                                           incremental, scorer, constants).max())
+            if trace is not None:
+                trace.count("check_candidates", len(all_pair_ids))
 
-    # evaluate and pick best line
-    fitness_list = [fitness(through_pixels_dict, image, line, darkness,
-                            lightness_penalty, w, w_pos, w_neg, line_norm_mode) for line in next_lines]
-    best_line_idx = fitness_list.index(max(fitness_list))
-    best_line = next_lines[best_line_idx]
+    if multires is not None and multires.check_due():
+        fitness_list = score_lines(line_pixels, image_flat, pair_ids, darkness, lightness_penalty,
+                                   w, w_pos, w_neg, line_norm_mode, incremental, scorer, constants)
+        multires.record_check(int(np.argmax(fitness_list)) in candidates)
+        if trace is not None:
+            trace.count("check_candidates", len(pair_ids))
+
+    if trace is not None:
+        trace.count("candidates", len(candidates))
+        if incremental is None:
+            # cached fitness values are read instead of pixels in incremental runs
+            scored = pair_ids[candidates]
+            trace.count("pixels_scored", int((line_pixels.offsets[scored + 1] - line_pixels.offsets[scored]).sum()))
+
+    if min_fitness is not None and best_fitness < min_fitness:
+        return image, None, 0, best_fitness
 
     # subtract the line from the image
-    pixels = through_pixels_dict[tuple(sorted(best_line))]
-    image[tuple(pixels.T)] -= darkness
+    pixels = line_pixels[best_line]
+    if trace is not None:
+        trace.count("pixels_drawn", len(pixels))
+    old_pixel_values = image_flat[pixels]
+    if old_pixel_values.dtype == np.int16 and old_pixel_values.min() - darkness < np.iinfo(np.int16).min:
+        raise OverflowError("Too many lines for a compact image, use a higher precision")
+    penalty_decrease = pixel_fitness(old_pixel_values, darkness, lightness_penalty,
+                                     weight_values(w, pixels), weight_values(w_pos, pixels),
+                                     weight_values(w_neg, pixels)).sum(dtype=np.float64)
+    if incremental is None:
+        image_flat[pixels] -= darkness
+    else:
+        incremental.subtract(image_flat, pair_ids[best_line_idx])
+    if multires is not None:
+        multires.subtract(pixels)
+
+    return image, best_line, penalty_decrease, best_fitness
+
+
+class SearchState:
+    """
+    Everything 'find_lines' needs to stop a run and continue it later: the residual image, the list of lines
+    drawn so far (the first one being just the starting hook), the initial and current penalty of the
+    image, the time spent, the seed of its line sampling (if used), the settings it was drawn with (see
+    'search_settings') and why the last run stopped.
+    The penalties of the last lines, precomputed line constants, incremental fitness cache,
+    multi-resolution pyramid and line sampler, if used, are kept too, but they are not saved to disk nor
+    pickled.
+    """
 
-    return image, best_line
+    def __init__(self, image, list_of_lines, initial_penalty=None, penalty=None, elapsed=0.0, sample_seed=None,
+                 settings=None):
+        self.image = image
+        self.list_of_lines = list_of_lines
+        self.initial_penalty = initial_penalty
+        self.penalty = penalty
+        self.elapsed = elapsed
+        self.sample_seed = sample_seed
+        self.settings = settings
+        self.stop_reason = None
+        self.recent_penalties = None
+        self.line_constants = None
+        self.incremental_fitness = None
+        self.multires = None
+        self.sampler = None
 
+    def __getstate__(self):
+        """
+        Pickles the state without its per-run caches (e.g. when a worker process sends it back), since they
+        refer to the line pixels, which are much larger than the image.
+        """
+        state = self.__dict__.copy()
+        for name in ["line_constants", "incremental_fitness", "multires", "sampler"]:
+            state[name] = None
+        return state
 
-def find_lines(through_pixels_dict, n_hooks, wheel_pixel_size, image, n_lines, darkness, lightness_penalty,
-               line_norm_mode, w=None, w_pos=None, w_neg=None, line_sample_fraction=1):
+    @staticmethod
+    def new(image, n_hooks, scratch_dir=None):
+        """
+        State of a run that has not drawn any line yet, starting from a random hook.
+        The image is copied, into a scratch array if 'scratch_dir' is given (see 'scratch_array').
+        """
+        previous_edge = np.random.choice(n_hooks)
+        print("starting hook: "+str(previous_edge))
+        return SearchState(image.copy() if scratch_dir is None else to_scratch(image, scratch_dir),
+                           [[previous_edge, previous_edge]])
+
+    def save(self, file_name):
+        """
+        Saves the state, along with the global NumPy random state, into a compressed .npz file.
+        The file is written next to 'file_name' first and then renamed, so it is never left half written.
+        """
+        rng_name, rng_keys, rng_pos, rng_has_gauss, rng_cached_gaussian = np.random.get_state()
+        tmp_file_name = f"{file_name}.tmp{os.getpid()}"
+        with open(tmp_file_name, 'wb') as f:
+            np.savez_compressed(f, image=self.image, list_of_lines=np.array(self.list_of_lines),
+                                initial_penalty=self.initial_penalty, penalty=self.penalty,
+                                elapsed=self.elapsed, rng_keys=rng_keys,
+                                sample_seed=-1 if self.sample_seed is None else self.sample_seed,
+                                rng_state=np.array([rng_pos, rng_has_gauss]),
+                                rng_cached_gaussian=rng_cached_gaussian, **({} if self.settings is None else
+                                                                            self.settings))
+        os.replace(tmp_file_name, file_name)
+
+    @staticmethod
+    def load(file_name):
+        """
+        Loads a state saved with 'save', and restores the global NumPy random state saved with it.
+        """
+        with np.load(file_name) as data:
+            rng_pos, rng_has_gauss = data["rng_state"].tolist()
+            np.random.set_state(("MT19937", data["rng_keys"], rng_pos, rng_has_gauss,
+                                 float(data["rng_cached_gaussian"])))
+            # checkpoints made before line sampling was seeded have no sample seed
+            sample_seed = int(data["sample_seed"]) if "sample_seed" in data.files else -1
+            # nor do checkpoints made before the settings were saved
+            settings = {name: data[name].item() for name in SEARCH_SETTINGS} \
+                if all(name in data.files for name in SEARCH_SETTINGS) else None
+            return SearchState(data["image"], data["list_of_lines"].tolist(),
+                               float(data["initial_penalty"]), float(data["penalty"]),
+                               float(data["elapsed"]), None if sample_seed < 0 else sample_seed, settings)
+
+    def changed_settings(self, settings):
+        """
+        Names of the settings (see 'search_settings') that differ from the ones the state was drawn with.
+        Returns None if the state does not know its settings (e.g. it was loaded from an older checkpoint).
+        """
+        if self.settings is None:
+            return None
+        return [name for name in SEARCH_SETTINGS if self.settings[name] != settings[name]]
+
+
+# settings a run can only be continued with, saved in checkpoints
+SEARCH_SETTINGS = ["n_hooks", "darkness", "lightness_penalty", "weighting"]
+
+
+def search_settings(n_hooks, darkness, lightness_penalty, w=None, w_pos=None, w_neg=None):
+    """
+    The settings of a run that its state can only be continued with: number of hooks, darkness, lightness
+    penalty and weighting mode ("none", "weighted" or "dual").
+    """
+    weighting = "dual" if w_pos is not None or w_neg is not None else "none" if w is None else "weighted"
+    return {"n_hooks": int(n_hooks), "darkness": float(darkness), "lightness_penalty": float(lightness_penalty),
+            "weighting": weighting}
+
+
+def find_lines(line_pixels, n_hooks, wheel_pixel_size, image, n_lines, darkness, lightness_penalty,
+               line_norm_mode, w=None, w_pos=None, w_neg=None, line_sample_fraction=1, incremental=False,
+               state=None, multires_levels=0, multires_top_k=10, penalty_check_interval=0,
+               min_fitness=None, min_improvement=None, improvement_window=100, time_budget=None,
+               checkpoint_file=None, checkpoint_interval=500, multires_geometry=None, progress_callback=None,
+               workers=1, pregather_weights=False, trace=None, sample_policy="random", sample_top_k=20,
+               sample_check_interval=50):
     """
     Calls 'optimise_fitness' multiple times to draw a set of lines.
     Updates the image and the list of lines with each line drawn.
     Every 100 lines drawn, prints output that describes the progress of the algorithm (including average
     penalty, current runtime, and projected total runtime).
+    The penalty is kept up to date with the decrease of each line drawn, instead of being recomputed over
+    the whole image. To debug it, every 'penalty_check_interval' lines (if above 0) it is compared with
+    'get_penalty', printing any mismatch.
+    If 'incremental' is True, line fitness is cached and updated as lines are drawn (see 'IncrementalFitness').
+    If 'multires_levels' is above 0, candidates are shortlisted at lower resolutions first, keeping
+    'multires_top_k' lines for full resolution (see 'MultiResolution'), reusing 'multires_geometry' if given.
+    Besides stopping after 'n_lines' lines, the run can also stop automatically when the best line has a
+    fitness below 'min_fitness', when the average penalty improved less than 'min_improvement' over the
+    last 'improvement_window' lines, or after 'time_budget' seconds. The reason is kept in the state.
+    If a SearchState is given, the run continues from it (and 'image' is ignored) until there are 'n_lines'
+    lines, updating it as lines are drawn so it can be continued again later.
+    If 'checkpoint_file' is given, the state is saved into it every 'checkpoint_interval' lines and when the
+    run stops, so it can be resumed with 'SearchState.load' (incremental and multi-resolution caches are
+    rebuilt from the saved image).
+    Unless 'incremental' is True, line norms are only computed once per image, and so are the weightings of
+    every line pixel if 'pregather_weights' is True (see 'LineConstants').
+    If 'workers' is above 1, candidate lines are scored on that many threads (see 'ParallelScorer').
+    If 'progress_callback' is given, it is called with the amount of lines, 'n_lines', the average penalty and
+    the projected seconds left each time progress is printed, and once more (with 0 seconds left) at the end.
+    If 'trace' (a Trace) is given, the precomputation of the run and each line drawn are recorded into it.
+    If 'line_sample_fraction' is below 1, only that fraction of the candidate lines is scored at each step, picked
+    by a LineSampler with 'sample_policy', 'sample_top_k' and 'sample_check_interval', seeded with the sample seed
+    of the state (drawn from the global NumPy random state the first time). How much the sampling cost in
+    quality is printed at the end.
     """
-    previous_edge = np.random.choice(n_hooks)
-    list_of_lines = [[previous_edge, previous_edge]]
-    print("starting hook: "+str(previous_edge))
-
-    image_copy = image.copy()
-
-    for i in range(n_lines):
-        if i == 0:
-            t0 = time.time()
-            initial_penalty = get_penalty(
-                image_copy, lightness_penalty, w, w_pos, w_neg)
-            initial_avg_penalty = f'{initial_penalty / (wheel_pixel_size ** 2):.2f}'
-        elif i % 100 == 0:
-            t_so_far = time.strftime('%M:%S', time.gmtime(time.time() - t0))
-            t_left = time.strftime('%M:%S', time.gmtime(
-                (time.time() - t0) * (n_lines - i) / i))
-            penalty = get_penalty(image, lightness_penalty, w, w_pos, w_neg)
-            avg_penalty = f'{penalty / (wheel_pixel_size ** 2):.2f}'
+    if state is None:
+        state = SearchState.new(image, n_hooks)
+    state.settings = search_settings(n_hooks, darkness, lightness_penalty, w, w_pos, w_neg)
+    image_copy = state.image
+    list_of_lines = state.list_of_lines
+    previous_edge = list_of_lines[-1][1]
+
+    # contiguous weights can be flattened without copies in 'optimise_fitness'
+    w = None if w is None else np.ascontiguousarray(w)
+    w_pos = None if w_pos is None else np.ascontiguousarray(w_pos)
+    w_neg = None if w_neg is None else np.ascontiguousarray(w_neg)
+    with trace_phase(trace, "precompute"):
+        if not incremental and (state.line_constants is None or state.line_constants.gathered != pregather_weights):
+            state.line_constants = LineConstants(line_pixels, None if w is None else w.reshape(-1),
+                                                 None if w_pos is None else w_pos.reshape(-1),
+                                                 None if w_neg is None else w_neg.reshape(-1),
+                                                 line_norm_mode, pregather_weights)
+        if incremental and state.incremental_fitness is None:
+            state.incremental_fitness = IncrementalFitness(line_pixels, image_copy.reshape(-1), darkness,
+                                                           lightness_penalty,
+                                                           None if w is None else w.reshape(-1),
+                                                           None if w_pos is None else w_pos.reshape(-1),
+                                                           None if w_neg is None else w_neg.reshape(-1),
+                                                           line_norm_mode)
+        incremental_fitness = state.incremental_fitness if incremental else None
+        if multires_levels > 0 and state.multires is None:
+            state.multires = MultiResolution(n_hooks, wheel_pixel_size, image_copy.reshape(-1),
+                                             None if w is None else w.reshape(-1),
+                                             None if w_pos is None else w_pos.reshape(-1),
+                                             None if w_neg is None else w_neg.reshape(-1),
+                                             darkness, lightness_penalty, line_norm_mode,
+                                             multires_levels, multires_top_k, disk=line_pixels.disk,
+                                             geometry=multires_geometry)
+    multires = state.multires if multires_levels > 0 else None
+    if line_sample_fraction < 1:
+        if state.sample_seed is None:
+            state.sample_seed = int(np.random.randint(2 ** 31))
+        if state.sampler is None or (state.sampler.fraction, state.sampler.policy, state.sampler.top_k) != \
+                (line_sample_fraction, sample_policy, sample_top_k):
+            state.sampler = LineSampler(line_sample_fraction, sample_policy, sample_top_k, state.sample_seed,
+                                        sample_check_interval)
+    sampler = state.sampler if line_sample_fraction < 1 else None
+    scorer = ParallelScorer(workers) if workers > 1 else None
+
+    t0 = time.time()
+    t_last = t0
+    if state.initial_penalty is None:
+        state.initial_penalty = get_penalty(
+            image_copy, lightness_penalty, w, w_pos, w_neg)
+    if state.penalty is None:
+        state.penalty = get_penalty(image_copy, lightness_penalty, w, w_pos, w_neg)
+    initial_avg_penalty = f'{state.initial_penalty / (wheel_pixel_size ** 2):.2f}'
+    first_line = len(list_of_lines) - 1
+    # the penalties of the last lines are kept in the state, so convergence is measured across calls
+    if state.recent_penalties is None or state.recent_penalties.maxlen != improvement_window + 1:
+        state.recent_penalties = deque([state.penalty], maxlen=improvement_window + 1)
+    recent_penalties = state.recent_penalties
+    state.stop_reason = "lines"
+
+    for i in range(first_line, n_lines):
+        if i > first_line and i % 100 == 0:
+            t_so_far = time.strftime('%M:%S', time.gmtime(state.elapsed + time.time() - t_last))
+            seconds_left = (time.time() - t0) * (n_lines - i) / (i - first_line)
+            t_left = time.strftime('%M:%S', time.gmtime(seconds_left))
+            avg_penalty = f'{state.penalty / (wheel_pixel_size ** 2):.2f}'
             print(f"{i}/{n_lines}, average penalty = {avg_penalty}/{initial_avg_penalty}, "
                   f"time = {t_so_far}, time left = {t_left}    ", end="\r")
+            if progress_callback is not None:
+                progress_callback(i, n_lines, state.penalty / wheel_pixel_size ** 2, seconds_left)
+
+        if time_budget is not None and time.time() - t0 > time_budget:
+            state.stop_reason = "time"
+            break
 
-        image, line = optimise_fitness(through_pixels_dict, n_hooks, image_copy, previous_edge,
-                                       darkness, lightness_penalty, list_of_lines,
-                                       w, w_pos, w_neg, line_norm_mode, line_sample_fraction)
+        if trace is not None:
+            t_step = time.perf_counter()
+        image, line, penalty_decrease, best_fitness = optimise_fitness(
+            line_pixels, n_hooks, image_copy, previous_edge, darkness, lightness_penalty, list_of_lines,
+            w, w_pos, w_neg, line_norm_mode, line_sample_fraction, incremental_fitness, multires, min_fitness,
+            scorer, None if incremental else state.line_constants, trace, sampler)
+        if trace is not None:
+            trace.step(i, time.perf_counter() - t_step, best_fitness=float(best_fitness),
+                       penalty_decrease=float(penalty_decrease))
+        if line is None:
+            state.stop_reason = "fitness"
+            break
         previous_edge = line[1]
         list_of_lines.append(line)
+        state.penalty -= penalty_decrease
+
+        if penalty_check_interval > 0 and (i + 1) % penalty_check_interval == 0:
+            penalty = get_penalty(image_copy, lightness_penalty, w, w_pos, w_neg)
+            if not np.isclose(penalty, state.penalty, rtol=1e-9, atol=1e-6):
+                print(f"\npenalty mismatch at line {i + 1}: running = {state.penalty}, full = {penalty}")
+                state.penalty = penalty
+
+        recent_penalties.append(state.penalty)
+        if min_improvement is not None and len(recent_penalties) == recent_penalties.maxlen and \
+                (recent_penalties[0] - recent_penalties[-1]) / wheel_pixel_size ** 2 < min_improvement:
+            state.stop_reason = "converged"
+            break
+
+        if checkpoint_file is not None and checkpoint_interval > 0 and (i + 1) % checkpoint_interval == 0:
+            state.elapsed += time.time() - t_last
+            t_last = time.time()
+            state.save(checkpoint_file)
 
-    penalty = get_penalty(image_copy, lightness_penalty, w, w_pos, w_neg)
-    avg_penalty = f'{penalty / (wheel_pixel_size ** 2):.2f}'
+    state.elapsed += time.time() - t_last
+    if scorer is not None:
+        scorer.close()
+    if checkpoint_file is not None:
+        state.save(checkpoint_file)
+    avg_penalty = f'{state.penalty / (wheel_pixel_size ** 2):.2f}'
     print(f"{len(list_of_lines)}/{n_lines}, average penalty = {avg_penalty}/{initial_avg_penalty}")
-    print("time = " + time.strftime('%M:%S', time.gmtime(time.time() - t0)))
+    print("time = " + time.strftime('%M:%S', time.gmtime(state.elapsed)))
+    if state.stop_reason != "lines":
+        print("stopped early: " + state.stop_reason)
+    if progress_callback is not None:
+        progress_callback(len(list_of_lines) - 1, n_lines, state.penalty / wheel_pixel_size ** 2, 0)
+    if multires is not None:
+        multires.report()
+    if sampler is not None:
+        sampler.report()
+        if trace is not None:
+            trace.write("sampling", **sampler.summary())
 
     return list_of_lines
 
@@ -174,7 +879,14 @@ def get_penalty(image, lightness_penalty, w, w_pos, w_neg):
     This is different depending on whether importance weightings are being used.
     An image initially is [0, 255]. As lines are added, each pixel is subtracted the 'darkness' value,
     and it can become negative.
+    Memory-mapped images (see 'scratch_array') are summed a chunk of rows at a time, so they are never
+    loaded whole.
     """
+    if isinstance(image, np.memmap):
+        return sum(get_penalty(np.asarray(image[rows]), lightness_penalty,
+                               *(None if weights is None else np.asarray(weights[rows])
+                                 for weights in (w, w_pos, w_neg)))
+                   for rows in chunks(len(image), max(1, 2 ** 22 * len(image) // max(1, image.size))))
     if w is None and w_pos is None:
         # standard image penalty: sum all the pixels (so dark images where lines havent yet been added
         # have more penalty) and then check and add penalty for negative pixels
@@ -182,56 +894,478 @@ def get_penalty(image, lightness_penalty, w, w_pos, w_neg):
     elif w_pos is None:
         # weighted image penalty: create a weighted image based on w (multiplies all pixel values by [0,1]).
         #  Then sum all the pixels (bigger weights cause higher penalty) and add penalty for negative pixels
-        image_w = image * w
-        return image_w[image > 0].sum() - lightness_penalty * image_w[image < 0].sum()
+        image_w = image * weight_values(w)
+        return image_w[image > 0].sum(dtype=np.float64) - \
+            lightness_penalty * image_w[image < 0].sum(dtype=np.float64)
     elif w is None:
         # dual-weighted image penalty: create two weighted images, one for positive pixels, one for negatives.
         #  Then sum all the positive pixels (bigger weights cause higher penalty)
         #  and add penalty for negative pixels (bigger weights cause higher penalty)
-        image_wpos = image * w_pos
-        image_wneg = image * w_neg
-        return image_wpos[image > 0].sum() - lightness_penalty * image_wneg[image < 0].sum()
+        image_wpos = image * weight_values(w_pos)
+        image_wneg = image * weight_values(w_neg)
+        return image_wpos[image > 0].sum(dtype=np.float64) - \
+            lightness_penalty * image_wneg[image < 0].sum(dtype=np.float64)
+
+
+# 'find_lines' parameters used by 'ThreadArtEngine.run' unless given
+DEFAULT_PARAMS = {
+    "n_lines": 2500,
+    "darkness": 125,
+    "lightness_penalty": 0.5,
+}
+
+
+class ThreadArtEngine:
+    """
+    Draws portraits for one geometry (amount of hooks and wheel size in pixels), so that many images can be
+    drawn in the same process without repeating its setup. Hooks and line pixels are loaded once, and what
+    is derived from them (the inverted index used by incremental fitness, the line pixels of the
+    multi-resolution levels) is built the first time a run needs it and kept for the next ones.
+    Images are prepared with 'precision', and packed to the pixels inside the wheel if the line pixels are
+    (see 'LinePixels.to_disk').
+    If 'scratch_dir' is given, images (and the images being drawn) are scratch arrays memory-mapped from files in
+    that folder (see 'scratch_array'), so only the parts in use take memory. Line pixels are memory-mapped from
+    the geometry cache anyway.
+    """
+
+    def __init__(self, hooks, line_pixels, precision="double", scratch_dir=None):
+        self.hooks = hooks
+        self.line_pixels = line_pixels
+        self.n_hooks = line_pixels.n_hooks
+        self.wheel_pixel_size = line_pixels.wheel_pixel_size
+        self.precision = precision
+        self.scratch_dir = scratch_dir
+        self.multires_geometry = {}
+
+    @staticmethod
+    def load(n_hooks, wheel_pixel_size, cache_dir="cache", rebuild_cache=False, disk_only=False,
+             precision="double", scratch_dir=None):
+        """
+        Engine over the cached geometry of 'n_hooks' and 'wheel_pixel_size' (see 'load_geometry').
+        """
+        hooks, line_pixels = load_geometry(n_hooks, wheel_pixel_size, cache_dir, rebuild=rebuild_cache,
+                                           disk_only=disk_only)
+        return ThreadArtEngine(hooks, line_pixels, precision, scratch_dir)
+
+    def prepare(self, src_file, src_file_weighted=None, src_file_wpos=None, src_file_wneg=None):
+        """
+        Loads a source image, and its weighted images if given, for this engine.
+        Returns the image and a dict with the weighted images ("w", or "w_pos" and "w_neg"), for 'run'.
+        """
+        with image_cache([src_file, src_file_weighted, src_file_wpos, src_file_wneg]):
+            image = self.pack(prepare_image(src_file, self.wheel_pixel_size, precision=self.precision,
+                                            scratch_dir=self.scratch_dir))
+            return image, self.prepare_weights(src_file_weighted, src_file_wpos, src_file_wneg)
+
+    def prepare_weights(self, src_file_weighted=None, src_file_wpos=None, src_file_wneg=None):
+        """
+        Loads only the weighted images given, for this engine, as the dict returned by 'prepare'.
+        """
+        def prepare(file_name):
+            return self.pack(prepare_image(file_name, self.wheel_pixel_size, weighting=True,
+                                           precision=self.precision, scratch_dir=self.scratch_dir))
+
+        weights = {}
+        with image_cache([src_file_weighted, src_file_wpos, src_file_wneg]):
+            # image where black are weighted areas: they matter more in terms of accuracy
+            # you basically want the target black and the background white/grey
+            if src_file_weighted is not None:
+                weights["w"] = prepare(src_file_weighted)
+            if src_file_wpos is not None and src_file_wneg is not None:
+                weights["w_pos"] = prepare(src_file_wpos)
+                weights["w_neg"] = prepare(src_file_wneg)
+        return weights
+
+    def prepare_colours(self, src_file, palette):
+        """
+        Loads the images of each thread colour of 'palette' (RGB tuples) in a source image, for this engine
+        (see 'prepare_colour_layers').
+        """
+        return [self.pack(layer) for layer in
+                prepare_colour_layers(src_file, self.wheel_pixel_size, palette, self.precision)]
+
+    def pack(self, image):
+        """
+        Image in the layout of the line pixels of this engine: unchanged, or packed with 'pack_disk'.
+        With a scratch folder, it is also moved into a scratch array if it is not one yet.
+        """
+        if self.line_pixels.disk is not None:
+            return pack_disk(image, self.line_pixels.disk, self.scratch_dir)
+        if self.scratch_dir is not None and not isinstance(image, np.memmap):
+            return to_scratch(image, self.scratch_dir)
+        return image
+
+    def run(self, image, weights=None, params=None, state=None, checkpoint_file=None):
+        """
+        Draws lines over 'image' with 'find_lines', or continues 'state' (a SearchState) if given.
+        'weights' is a dict of weighted images as returned by 'prepare', and 'params' a dict of 'find_lines'
+        keyword arguments (n_lines, darkness, lightness_penalty, incremental, multires_levels, ...), with
+        defaults from DEFAULT_PARAMS.
+        Returns the SearchState of the run, with the lines drawn.
+        """
+        weights = {} if weights is None else weights
+        params = dict(DEFAULT_PARAMS, **({} if params is None else params))
+        line_norm_mode = LineNormalization.LENGTH if len(weights) == 0 else LineNormalization.WEIGHTED_LENGTH
+        if state is None:
+            state = SearchState.new(image, self.n_hooks, self.scratch_dir)
+        elif self.scratch_dir is not None and not isinstance(state.image, np.memmap):
+            # e.g. a state loaded from a checkpoint
+            state.image = to_scratch(state.image, self.scratch_dir)
+
+        multires_levels = params.get("multires_levels", 0)
+        if multires_levels > 0 and multires_levels not in self.multires_geometry:
+            self.multires_geometry[multires_levels] = MultiResolution.geometry(
+                self.n_hooks, self.wheel_pixel_size, multires_levels, self.line_pixels.disk)
+
+        find_lines(self.line_pixels, self.n_hooks, self.wheel_pixel_size, None, line_norm_mode=line_norm_mode,
+                   state=state, checkpoint_file=checkpoint_file,
+                   multires_geometry=self.multires_geometry.get(multires_levels), **weights, **params)
+        return state
+
+    def save_outputs(self, state, out_file, wheel_diameter_m, no_progress_output=False, progress_format="jpg"):
+        """
+        Saves the portrait drawn in 'state', its progress images, and the instructions to build it.
+        Returns the length of thread needed, in meters.
+        """
+        lines = state.list_of_lines
+        save_plot([lines], [(0, 0, 0)], out_file, self.wheel_pixel_size, self.n_hooks)
+        if not no_progress_output:
+            # one progress image every 100 lines actually drawn
+            save_plot_progress([lines], [(0, 0, 0)], out_file, self.wheel_pixel_size, self.n_hooks,
+                               np.arange(0.0, 1.0, 1.0/max(1, (len(lines) - 1)//100)), progress_format)
+        distance = total_distance(lines, self.hooks, wheel_diameter_m, self.wheel_pixel_size, out_file)
+        display_output(lines, out_file)
+        return distance
+
+    def save_colour_outputs(self, states, palette, out_file, wheel_diameter_m, no_progress_output=False,
+                            progress_format="jpg"):
+        """
+        Saves a multi-colour portrait (a SearchState per colour of 'palette'), with the layers drawn in the
+        order of the palette, and the instructions to build each layer in "'out_file'_<colour>.txt".
+        Progress images show all layers being drawn at the same time.
+        Returns the length of thread needed for each colour, in meters.
+        """
+        layers = [state.list_of_lines for state in states]
+        save_plot(layers, palette, out_file, self.wheel_pixel_size, self.n_hooks)
+        if not no_progress_output:
+            # one progress image every 100 lines of the largest layer
+            save_plot_progress(layers, palette, out_file, self.wheel_pixel_size, self.n_hooks,
+                               np.arange(0.0, 1.0, 1.0/max(1, max(len(lines) - 1 for lines in layers)//100)),
+                               progress_format, together=True)
+        distances = []
+        for lines, colour in zip(layers, palette):
+            layer_file = f"{out_file}_{colour_name(colour)}"
+            distances.append(total_distance(lines, self.hooks, wheel_diameter_m, self.wheel_pixel_size,
+                                            layer_file))
+            display_output(lines, layer_file)
+        return distances
+
+
+def draw_portrait(engine, src_file, src_file_weighted, src_file_wpos, src_file_wneg, out_file,
+                  no_progress_output, wheel_diameter_m, params, checkpoint_interval=500, resume=False,
+                  progress_format="jpg", trace=None):
+    """
+    Draws one portrait with 'engine' and saves its outputs next to 'out_file'.
+    The run is checkpointed into 'out_file'.state.npz every 'checkpoint_interval' lines (if above 0), and if
+    'resume' is True it continues from there. Returns its SearchState, or None if the checkpoint does not
+    match the engine or the run's settings.
+    If 'trace' (a Trace) is given, the time spent preparing images, searching lines and saving outputs is
+    recorded into it.
+    """
+    with trace_phase(trace, "prepare"):
+        image_m, weights = engine.prepare(src_file, src_file_weighted, src_file_wpos, src_file_wneg)
+
+    # the run is checkpointed next to its outputs, and can be resumed (or extended with more lines) from there
+    checkpoint_file = out_file + ".state.npz"
+    state = None
+    if resume:
+        if not os.path.isfile(checkpoint_file):
+            print("No checkpoint " + checkpoint_file + " to resume from, starting a new run")
+        else:
+            state = SearchState.load(checkpoint_file)
+            if state.image.shape != image_m.shape:
+                print("Checkpoint " + checkpoint_file + " was made with another line width or --disk_only setting")
+                return None
+            params = dict(DEFAULT_PARAMS, **params)
+            changed = state.changed_settings(search_settings(engine.n_hooks, params["darkness"],
+                                                             params["lightness_penalty"], **weights))
+            if changed is None:
+                print("Checkpoint " + checkpoint_file + " does not record its settings, they are not checked")
+            elif len(changed) > 0:
+                print("Checkpoint " + checkpoint_file + " was made with other settings: " + ", ".join(changed))
+                return None
+            print(f"resuming from {checkpoint_file} with {len(state.list_of_lines) - 1} lines")
+
+    with trace_phase(trace, "search"):
+        state = engine.run(image_m, weights, dict(params, checkpoint_interval=checkpoint_interval, trace=trace),
+                           state=state, checkpoint_file=checkpoint_file if checkpoint_interval > 0 else None)
+    with trace_phase(trace, "render"):
+        engine.save_outputs(state, out_file, wheel_diameter_m, no_progress_output, progress_format)
+    if trace is not None:
+        trace.write("run", lines=len(state.list_of_lines) - 1, stop_reason=state.stop_reason,
+                    avg_penalty=state.penalty / engine.wheel_pixel_size ** 2)
+    return state
+
+
+def colour_name(colour):
+    """
+    Hex string of an RGB tuple, used to name the outputs of each colour.
+    """
+    return "".join(f"{value:02x}" for value in colour)
+
+
+def colour_line_counts(layers, n_lines):
+    """
+    Splits 'n_lines' among colour layers in proportion to how much thread each one needs (the sum of its image).
+    """
+    darkness = np.array([layer.sum(dtype=np.float64) for layer in layers])
+    shares = darkness / darkness.sum() if darkness.sum() > 0 else np.full(len(layers), 1 / len(layers))
+    return [max(1, int(round(n_lines * share))) for share in shares]
+
+
+def run_colour_layer(job):
+    """
+    Draws the lines of one colour layer in a worker, logging the progress output of 'find_lines' into a file.
+    Returns the state of the layer.
+    """
+    state, weights, params, log_file = job
+    with open(log_file, 'a') as log, contextlib.redirect_stdout(log):
+        return _worker_engine.run(None, weights, params, state=state)
+
+
+def run_colours(engine, layers, weights, params, layer_lines, log_files, mode="interleaved", interleave_lines=100,
+                cache_dir="cache"):
+    """
+    Draws the lines of every colour layer ('layers' as returned by 'ThreadArtEngine.prepare_colours'), with
+    'layer_lines' lines for each. The weighted images, if any, are used for every layer.
+    Layers are independent images, so they can be drawn:
+     "interleaved", taking turns of 'interleave_lines' lines each in this process, so all colours progress
+        together and share any time budget;
+     "parallel", one process per layer (up to the amount of CPUs), each loading the same read-only line
+        pixels from 'cache_dir', and each with the full time budget.
+    The progress output of each layer goes into its file of 'log_files'.
+    Returns the SearchState of every layer.
+    """
+    states = [SearchState.new(layer, engine.n_hooks) for layer in layers]
+    params = dict(params)
+    time_budget = params.pop("time_budget", None)
+
+    if mode == "parallel":
+        # a trace cannot be shared with other processes, so lines drawn in parallel are not traced
+        params.pop("trace", None)
+        if params.get("line_sample_fraction", 1) < 1:
+            # workers start with the same global random state, so each layer is given its own sample seed here
+            for state in states:
+                state.sample_seed = int(np.random.randint(2 ** 31))
+        jobs = [(state, weights, dict(params, n_lines=n_lines, time_budget=time_budget), log_file)
+                for state, n_lines, log_file in zip(states, layer_lines, log_files)]
+        with Pool(min(len(jobs), os.cpu_count()), initializer=init_engine_worker,
+                  initargs=(engine.n_hooks, engine.wheel_pixel_size, cache_dir,
+                            engine.line_pixels.disk is not None, engine.precision, engine.scratch_dir)) as pool:
+            states = pool.map(run_colour_layer, jobs)
+    else:
+        t0 = time.time()
+        active = list(range(len(states)))
+        while len(active) > 0:
+            for layer in list(active):
+                state = states[layer]
+                layer_params = dict(params, n_lines=min(layer_lines[layer],
+                                                        len(state.list_of_lines) - 1 + interleave_lines))
+                if time_budget is not None:
+                    layer_params["time_budget"] = max(0, time_budget - (time.time() - t0))
+                with open(log_files[layer], 'a') as log, contextlib.redirect_stdout(log):
+                    engine.run(None, weights, layer_params, state=state)
+                if state.stop_reason != "lines" or len(state.list_of_lines) - 1 >= layer_lines[layer]:
+                    active.remove(layer)
+            lines_drawn = ", ".join(f"{len(state.list_of_lines) - 1}/{n_lines}"
+                                    for state, n_lines in zip(states, layer_lines))
+            print(f"{lines_drawn} lines, time = {time.strftime('%M:%S', time.gmtime(time.time() - t0))}    ",
+                  end="\r")
+        print()
+
+    for state, log_file in zip(states, log_files):
+        print(f"{os.path.basename(log_file)[:-4]}: {len(state.list_of_lines) - 1} lines, "
+              f"average penalty = {state.penalty / engine.wheel_pixel_size ** 2:.2f}/"
+              f"{state.initial_penalty / engine.wheel_pixel_size ** 2:.2f}, time = "
+              f"{time.strftime('%M:%S', time.gmtime(state.elapsed))}, stopped by {state.stop_reason}")
+    return states
+
+
+def draw_colour_portrait(engine, src_file, src_file_weighted, src_file_wpos, src_file_wneg, out_file,
+                         no_progress_output, wheel_diameter_m, params, palette, colour_lines=None,
+                         colour_mode="interleaved", progress_format="jpg", cache_dir="cache", trace=None):
+    """
+    Draws a multi-colour portrait of a source image with 'engine', with a layer of lines per colour of 'palette',
+    and saves its outputs next to 'out_file'. The lines of each layer are 'colour_lines', or params["n_lines"]
+    split among them (see 'colour_line_counts'). Returns the SearchState of every layer.
+    If 'trace' (a Trace) is given, phases are recorded into it as in 'draw_portrait'.
+    """
+    with trace_phase(trace, "prepare"):
+        layers = engine.prepare_colours(src_file, palette)
+        weights = engine.prepare_weights(src_file_weighted, src_file_wpos, src_file_wneg)
+    if colour_lines is None:
+        colour_lines = colour_line_counts(layers, params["n_lines"])
+    print("lines per colour: " + ", ".join(f"{colour_name(colour)} = {n_lines}"
+                                           for colour, n_lines in zip(palette, colour_lines)))
+
+    with trace_phase(trace, "search"):
+        states = run_colours(engine, layers, weights, dict(params, trace=trace), colour_lines,
+                             [f"{out_file}_{colour_name(colour)}.log" for colour in palette], colour_mode,
+                             cache_dir=cache_dir)
+    with trace_phase(trace, "render"):
+        distances = engine.save_colour_outputs(states, palette, out_file, wheel_diameter_m, no_progress_output,
+                                               progress_format)
+    if trace is not None:
+        for colour, state in zip(palette, states):
+            trace.write("run", colour=colour_name(colour), lines=len(state.list_of_lines) - 1,
+                        stop_reason=state.stop_reason, avg_penalty=state.penalty / engine.wheel_pixel_size ** 2)
+    print("distance = " + ", ".join(f"{colour_name(colour)} {int(distance)} meters"
+                                    for colour, distance in zip(palette, distances)))
+    return states
 
 
 def main(src_file, src_file_weighted, src_file_wpos, src_file_wneg,
          out_file, no_progress_output,
          n_hooks, n_lines, line_darkness, light_penalty,
-         wheel_diameter_m, wheel_pixel_size):
-    hooks = generate_hooks(n_hooks, wheel_pixel_size)
-    through_pixels_dict = build_through_pixels_dict(
-        hooks, n_hooks, wheel_pixel_size)
-
-    image_m = prepare_image(src_file, wheel_pixel_size)
-    image_w = None
-    image_w_pos = None
-    image_w_neg = None
-    line_norm_mode = LineNormalization.LENGTH
-    # image where black are weighted areas: they matter more in terms of accuracy
-    # you basically want the target black and the background white/grey
-    if src_file_weighted is not None:
-        image_w = prepare_image(src_file_weighted,
-                                wheel_pixel_size, weighting=True)
-        line_norm_mode = LineNormalization.WEIGHTED_LENGTH
-    if src_file_wpos is not None and src_file_wneg is not None:
-        image_w_pos = prepare_image(src_file_wpos,
-                                    wheel_pixel_size, weighting=True)
-        image_w_neg = prepare_image(src_file_wneg,
-                                    wheel_pixel_size, weighting=True)
-        line_norm_mode = LineNormalization.WEIGHTED_LENGTH
-
-    lines = find_lines(through_pixels_dict, n_hooks, wheel_pixel_size,
-                       image_m, n_lines=n_lines,
-                       darkness=line_darkness, lightness_penalty=light_penalty,
-                       w=image_w, w_pos=image_w_pos, w_neg=image_w_neg,
-                       line_norm_mode=line_norm_mode,
-                       line_sample_fraction=1)
-
-    save_plot([lines], [(0, 0, 0)], out_file, wheel_pixel_size, n_hooks)
-    if not no_progress_output:
-        save_plot_progress([lines], [(0, 0, 0)], out_file, wheel_pixel_size, n_hooks,
-                        np.arange(0.0, 1.0, 1.0/(n_lines//100)))
-    total_distance(lines, hooks, wheel_diameter_m, wheel_pixel_size, out_file)
-    display_output(lines, out_file)
+         wheel_diameter_m, wheel_pixel_size,
+         cache_dir="cache", rebuild_cache=False, incremental=False,
+         multires_levels=0, multires_top_k=10, penalty_check_interval=0,
+         min_fitness=None, min_improvement=None, improvement_window=100, time_budget=None,
+         checkpoint_interval=500, resume=False, progress_format="jpg", precision="double", disk_only=False,
+         workers=1, pregather_weights=False, palette=None, colour_lines=None, colour_mode="interleaved",
+         trace_options=None, line_sample_fraction=1, sample_policy="random", sample_top_k=20, seed=None,
+         scratch_dir=None):
+    if seed is not None:
+        np.random.seed(seed)
+    if scratch_dir is not None and (incremental or pregather_weights or multires_levels > 0):
+        print("--incremental, --pregather_weights and --multires_levels still keep arrays as large as the "
+              "images or line pixels in memory with --scratch_dir")
+    # the run is traced if 'trace_options' (keyword arguments of 'Trace') are given
+    with contextlib.nullcontext() if trace_options is None else Trace(**trace_options) as trace:
+        with trace_phase(trace, "load_geometry", n_hooks=n_hooks, wheel_pixel_size=wheel_pixel_size):
+            engine = ThreadArtEngine.load(n_hooks, wheel_pixel_size, cache_dir, rebuild_cache, disk_only,
+                                          precision, scratch_dir)
+        params = {"n_lines": n_lines, "darkness": line_darkness, "lightness_penalty": light_penalty,
+                  "incremental": incremental, "multires_levels": multires_levels, "multires_top_k": multires_top_k,
+                  "penalty_check_interval": penalty_check_interval, "min_fitness": min_fitness,
+                  "min_improvement": min_improvement, "improvement_window": improvement_window,
+                  "time_budget": time_budget, "workers": workers, "pregather_weights": pregather_weights,
+                  "line_sample_fraction": line_sample_fraction, "sample_policy": sample_policy,
+                  "sample_top_k": sample_top_k}
+
+        if palette is not None:
+            if resume:
+                print("Multi-colour runs are not checkpointed, --resume is ignored")
+            draw_colour_portrait(engine, src_file, src_file_weighted, src_file_wpos, src_file_wneg, out_file,
+                                 no_progress_output, wheel_diameter_m, params, palette, colour_lines, colour_mode,
+                                 progress_format, cache_dir, trace)
+            return
+
+        state = draw_portrait(engine, src_file, src_file_weighted, src_file_wpos, src_file_wneg, out_file,
+                              no_progress_output, wheel_diameter_m, params, checkpoint_interval, resume,
+                              progress_format, trace)
+    if state is None:
+        exit(0)
+
+
+# engine of each worker process, loaded once by 'init_engine_worker'
+_worker_engine = None
+
+
+def init_engine_worker(n_hooks, wheel_pixel_size, cache_dir, disk_only, precision, scratch_dir=None):
+    global _worker_engine
+    _worker_engine = ThreadArtEngine.load(n_hooks, wheel_pixel_size, cache_dir, disk_only=disk_only,
+                                         precision=precision, scratch_dir=scratch_dir)
+
+
+def run_batch_job(job):
+    """
+    Draws one portrait of a batch in a worker, logging the progress output of 'find_lines' into its folder,
+    and tracing it there too if the job has "trace_options".
+    Returns the job with the result of the run.
+    """
+    trace_options = job["trace_options"]
+    if trace_options is not None:
+        trace_options = dict(trace_options, file_name=os.path.join(job["dst_dir"], trace_options["file_name"]))
+    if job["seed"] is not None:
+        # each image is seeded, whichever worker draws it
+        np.random.seed(job["seed"])
+    with open(os.path.join(job["dst_dir"], "log.txt"), 'a') as log, contextlib.redirect_stdout(log), \
+            contextlib.nullcontext() if trace_options is None else Trace(**trace_options) as trace:
+        t0 = time.time()
+        state = draw_portrait(_worker_engine, job["src"], job["weighted"], job["wpos"], job["wneg"],
+                              os.path.join(job["dst_dir"], "out"), job["no_progress_output"], job["wheel_m"],
+                              job["params"], job["checkpoint_interval"], job["resume"], job["progress_format"],
+                              trace)
+    if state is None:
+        return dict(job, lines_drawn=None, avg_penalty=None, runtime_s=round(time.time() - t0, 2))
+    return dict(job, lines_drawn=len(state.list_of_lines) - 1,
+                avg_penalty=round(state.penalty / _worker_engine.wheel_pixel_size ** 2, 4),
+                runtime_s=round(time.time() - t0, 2))
+
+
+# extensions of the images picked up by --batch
+BATCH_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".tif", ".tiff", ".webp")
+
+
+def batch_jobs(src_dir, dst_dir):
+    """
+    Finds the source images in 'src_dir', along with their weighted images, which are found by name:
+    for "name.jpg", "name_weighted.*" is used with --weighted, and "name_wpos.*" and "name_wneg.*" with
+    --dual_weighted. Returns a job (source, weighted images and output folder) per source image.
+    """
+    image_files = {}
+    for file_name in sorted(os.listdir(src_dir)):
+        stem, extension = os.path.splitext(file_name)
+        if extension.lower() in BATCH_EXTENSIONS:
+            image_files.setdefault(stem, os.path.join(src_dir, file_name))
+
+    jobs = []
+    for stem, file_name in image_files.items():
+        if stem.endswith(("_weighted", "_wpos", "_wneg")) and stem.rsplit("_", 1)[0] in image_files:
+            continue
+        wpos = image_files.get(stem + "_wpos")
+        wneg = image_files.get(stem + "_wneg")
+        if wpos is None or wneg is None:
+            wpos, wneg = None, None
+        jobs.append({"src": file_name, "weighted": None if wpos is not None else image_files.get(stem + "_weighted"),
+                     "wpos": wpos, "wneg": wneg, "dst_dir": os.path.join(dst_dir, stem)})
+    return jobs
+
+
+def batch_main(src_dir, dst_dir, no_progress_output, n_hooks, wheel_diameter_m, wheel_pixel_size, params,
+               n_workers, cache_dir="cache", rebuild_cache=False, checkpoint_interval=500, resume=False,
+               progress_format="jpg", precision="double", disk_only=False, trace_options=None, seed=None,
+               scratch_dir=None):
+    """
+    Draws a portrait of every image in 'src_dir' (see 'batch_jobs') over a pool of 'n_workers' processes,
+    each holding a ThreadArtEngine, so the geometry is only set up once per worker.
+    Outputs of each image go into their own folder in 'dst_dir', along with a trace of its run named
+    trace_options["file_name"] if 'trace_options' (keyword arguments of 'Trace') are given.
+    If 'seed' is given, every image is drawn with it, so the batch is reproducible.
+    With 'scratch_dir', workers keep their images in scratch files there (see 'ThreadArtEngine').
+    """
+    jobs = batch_jobs(src_dir, dst_dir)
+    if len(jobs) == 0:
+        print("No images found in " + src_dir)
+        return []
+    for job in jobs:
+        os.makedirs(job["dst_dir"], exist_ok=True)
+        job.update({"no_progress_output": no_progress_output, "wheel_m": wheel_diameter_m, "params": params,
+                    "checkpoint_interval": checkpoint_interval, "resume": resume,
+                    "progress_format": progress_format, "trace_options": trace_options, "seed": seed})
+
+    # build the geometry cache once, before the workers load it
+    load_geometry(n_hooks, wheel_pixel_size, cache_dir, rebuild=rebuild_cache, disk_only=disk_only)
+    print(f"drawing {len(jobs)} images on {n_workers} workers")
+    results = []
+    with Pool(min(n_workers, len(jobs)), initializer=init_engine_worker,
+              initargs=(n_hooks, wheel_pixel_size, cache_dir, disk_only, precision, scratch_dir)) as pool:
+        for result in pool.imap_unordered(run_batch_job, jobs):
+            results.append(result)
+            print(f"{len(results)}/{len(jobs)} done: {result['dst_dir']}, lines = {result['lines_drawn']}, "
+                  f"average penalty = {result['avg_penalty']}, time = {result['runtime_s']}s")
+    return results
 
 
 if __name__ == "__main__":
@@ -239,7 +1373,23 @@ if __name__ == "__main__":
         description='''Creates threaded paintings based on a source image. Records instructions \
             to build them in real life.'''
     )
-    parser.add_argument('src', help='''Source file (.jpg, .png, ...)''')
+    parser.add_argument('src', nargs='?', default=None, help='''Source file (.jpg, .png, ...)''')
+    parser.add_argument('--batch', default=None, dest='batch',
+                        help='''Folder of source files to draw instead of src, each into its own folder in --dst_dir. \
+                            Weighted images are found by name: name_weighted.jpg, or name_wpos.jpg and name_wneg.jpg''')
+    parser.add_argument('--workers', type=int, default=1, dest='workers',
+                        help='''Amount of threads scoring candidate lines in parallel (default: 1)''')
+    parser.add_argument('--pregather_weights', action='store_true', dest='pregather_weights',
+                        help='''Whether to store the weightings of every line pixel once per image, so each step only reads the image (faster with weighted images, uses as much memory as the line pixels per weighted image)''')
+    parser.add_argument('--palette', type=parse_colour, nargs='+', default=None, dest='palette',
+                        help='''Thread colours in hex (e.g. 000000 ff0000 0000ff), for a multi-colour portrait with a layer of lines per colour''')
+    parser.add_argument('--colour_lines', type=int, nargs='+', default=None, dest='colour_lines',
+                        help='''Amount of lines of each colour of --palette (default: --lines split by how much of each colour the image has)''')
+    parser.add_argument('--colour_mode', default="interleaved", choices=["interleaved", "parallel"],
+                        dest='colour_mode',
+                        help='''Whether to draw --palette layers taking turns in one process, or in one process per colour (default: interleaved)''')
+    parser.add_argument('--batch_workers', type=int, default=os.cpu_count(), dest='batch_workers',
+                        help='''Amount of parallel processes with --batch (default: amount of CPUs)''')
     parser.add_argument('--dst_dir', default="out", dest='dst_dir',
                         help='''Folder to output files into''')
     parser.add_argument('--hooks', type=int, default=360, dest='hooks',
@@ -264,9 +1414,71 @@ if __name__ == "__main__":
                          help='''Two secondary images, with first (wpos) having important zones with dark masks and second (wneg) having clear zones with dark masks''')
     parser.add_argument('--no_progress_output', action='store_true', dest='no_progress_output',
                         help='''Whether to create progress images every 100 lines (default: True)''')
+    parser.add_argument('--cache_dir', default="cache", dest='cache_dir',
+                        help='''Folder where hooks and line pixels are cached between runs (default: cache)''')
+    group_c = parser.add_mutually_exclusive_group()
+    group_c.add_argument('--rebuild_cache', action='store_true', dest='rebuild_cache',
+                         help='''Whether to rebuild the cached line pixels for this amount of hooks and line width''')
+    group_c.add_argument('--clear_cache', action='store_true', dest='clear_cache',
+                         help='''Whether to delete all cached line pixels before running''')
+    parser.add_argument('--incremental', action='store_true', dest='incremental',
+                        help='''Whether to cache line fitness and only update lines crossing each new line (faster for many lines, uses more memory)''')
+    parser.add_argument('--multires_levels', type=int, default=0, dest='multires_levels',
+                        help='''Amount of lower resolution levels used to shortlist lines before scoring them at full resolution (default: 0, disabled)''')
+    parser.add_argument('--multires_top_k', type=int, default=10, dest='multires_top_k',
+                        help='''Amount of shortlisted lines scored at full resolution, with --multires_levels (default: 10)''')
+    parser.add_argument('--check_penalty', type=int, default=0, dest='check_penalty',
+                        help='''Debug option: every this amount of lines, compare the running penalty with one computed over the whole image (default: 0, disabled)''')
+    parser.add_argument('--min_fitness', type=float, default=None, dest='min_fitness',
+                        help='''Stop early when the best line has a fitness below this value (e.g. 0)''')
+    parser.add_argument('--min_improvement', type=float, default=None, dest='min_improvement',
+                        help='''Stop early when the average penalty improves less than this value over --improvement_window lines''')
+    parser.add_argument('--improvement_window', type=int, default=100, dest='improvement_window',
+                        help='''Amount of lines over which --min_improvement is measured (default: 100)''')
+    parser.add_argument('--time_budget', type=float, default=None, dest='time_budget',
+                        help='''Stop early after drawing lines for this amount of seconds''')
+    parser.add_argument('--progress_format', default="jpg", choices=["jpg", "frames", "gif", "webp"],
+                        dest='progress_format',
+                        help='''How to save progress images: one jpg per percentage, a numbered jpg sequence, or a single animation, at most 800px wide (default: jpg)''')
+    parser.add_argument('--precision', default="double", choices=["double", "single", "compact"],
+                        dest='precision',
+                        help='''Precision of images in memory: int64/float64 weights, int16/float32 weights, or int16/8 bit weights (default: double)''')
+    parser.add_argument('--checkpoint_every', type=int, default=500, dest='checkpoint_every',
+                        help='''Save the state of the run every this amount of lines, and when it ends (default: 500, 0 disables it)''')
+    parser.add_argument('--resume', action='store_true', dest='resume',
+                        help='''Whether to continue the last run in --dst_dir from its checkpoint, up to --lines lines (also extends finished runs)''')
+    parser.add_argument('--disk_only', action='store_true', dest='disk_only',
+                        help='''Whether to only keep the pixels inside the wheel in images (about 21%% less memory per image, the line pixels being remapped once into the geometry cache)''')
+    parser.add_argument('--trace', default=None, dest='trace',
+                        help='''Name of a JSON lines file in --dst_dir (or in the folder of each image with --batch) recording the time spent in each phase of the run and totals of candidate lines and pixels scored''')
+    parser.add_argument('--trace_steps', type=int, default=0, dest='trace_steps',
+                        help='''With --trace, also record one line drawn every this amount of lines, with its time, candidates, pixels and best fitness (default: 0, disabled)''')
+    parser.add_argument('--trace_profile', action='store_true', dest='trace_profile',
+                        help='''With --trace, whether to also profile the run with cProfile into the trace file name + .prof''')
+    parser.add_argument('--trace_memory', action='store_true', dest='trace_memory',
+                        help='''With --trace, whether to also record the peak memory of each phase with tracemalloc (slow)''')
+    parser.add_argument('--line_sample_fraction', type=float, default=1, dest='line_sample_fraction',
+                        help='''Fraction (0, 1] of the candidate lines scored at each step, faster but with worse lines (default: 1, all of them)''')
+    parser.add_argument('--sample_policy', default="random", choices=["random", "adaptive"], dest='sample_policy',
+                        help='''With --line_sample_fraction, whether to sample candidate lines at random, or to also rescore the best lines found the last time a line started from the same hook (default: random)''')
+    parser.add_argument('--sample_top_k', type=int, default=20, dest='sample_top_k',
+                        help='''Amount of best lines rescored by --sample_policy adaptive (default: 20)''')
+    parser.add_argument('--seed', type=int, default=None, dest='seed',
+                        help='''Seed of the starting hook and of --line_sample_fraction, to reproduce a run''')
+    parser.add_argument('--scratch_dir', default=None, dest='scratch_dir',
+                        help='''Folder where images being drawn are kept in memory-mapped files instead of memory, for very thin lines on machines with little memory (best with --precision compact)''')
     args = parser.parse_args()
 
     # sanitize input
+    if (args.batch is None) == (args.src is None):
+        print("Either a source file or --batch must be given")
+        exit(0)
+    if args.colour_lines is not None and (args.palette is None or len(args.colour_lines) != len(args.palette)):
+        print("--colour_lines needs one amount of lines per --palette colour")
+        exit(0)
+    if args.batch is not None and not os.path.isdir(args.batch):
+        print("Folder " + args.batch + " does not exist")
+        exit(0)
     if file_path_invalid(args.src) or \
             file_path_invalid(args.weighted) or \
             file_path_invalid(args.dual_weighted[0]) or \
@@ -284,11 +1496,39 @@ if __name__ == "__main__":
     n_lines = max_lines if args.max_lines else max(1, min(args.lines, max_lines))
     line_darkness = max(0, min(255, args.line_darkness))
     light_penalty = max(0, min(1, args.light_penalty))
+    line_sample_fraction = max(0.001, min(1, args.line_sample_fraction))
     wheel_m = max(0.1, args.wheel_m)
     line_w_milim = max(0.01, args.line_w)
     line_w_m = line_w_milim / 1000      # line width in meters
     wheel_p = int(1 / line_w_m)         # diameter (in pixels) of thread portrait
+    if args.clear_cache:
+        clear_geometry_cache(args.cache_dir)
+    trace_options = None if args.trace is None else {"file_name": args.trace,
+                                                     "step_interval": max(0, args.trace_steps),
+                                                     "profile": args.trace_profile, "memory": args.trace_memory}
 
+    if args.batch is not None:
+        batch_main(args.batch, args.dst_dir, args.no_progress_output, n_hooks, wheel_m, wheel_p,
+                   {"n_lines": n_lines, "darkness": line_darkness, "lightness_penalty": light_penalty,
+                    "incremental": args.incremental, "multires_levels": max(0, args.multires_levels),
+                    "multires_top_k": max(1, args.multires_top_k), "penalty_check_interval": max(0, args.check_penalty),
+                    "min_fitness": args.min_fitness, "min_improvement": args.min_improvement,
+                    "improvement_window": max(1, args.improvement_window), "time_budget": args.time_budget,
+                    "workers": max(1, args.workers), "pregather_weights": args.pregather_weights,
+                    "line_sample_fraction": line_sample_fraction, "sample_policy": args.sample_policy,
+                    "sample_top_k": max(1, args.sample_top_k)},
+                   max(1, args.batch_workers), args.cache_dir, args.rebuild_cache, max(0, args.checkpoint_every),
+                   args.resume, args.progress_format, args.precision, args.disk_only, trace_options, args.seed,
+                   args.scratch_dir)
+        exit(0)
     main(args.src, args.weighted, args.dual_weighted[0], args.dual_weighted[1],
          os.path.join(args.dst_dir, "out"), args.no_progress_output,
-         n_hooks, n_lines, line_darkness, light_penalty, wheel_m, wheel_p)
+         n_hooks, n_lines, line_darkness, light_penalty, wheel_m, wheel_p,
+         args.cache_dir, args.rebuild_cache, args.incremental,
+         max(0, args.multires_levels), max(1, args.multires_top_k), max(0, args.check_penalty),
+         args.min_fitness, args.min_improvement, max(1, args.improvement_window), args.time_budget,
+         max(0, args.checkpoint_every), args.resume, args.progress_format, args.precision,
+         args.disk_only, max(1, args.workers), args.pregather_weights, args.palette,
+         None if args.colour_lines is None else [max(1, n) for n in args.colour_lines], args.colour_mode,
+         None if trace_options is None else dict(trace_options, file_name=os.path.join(args.dst_dir, args.trace)),
+         line_sample_fraction, args.sample_policy, max(1, args.sample_top_k), args.seed, args.scratch_dir)
@@ -5,72 +5,287 @@
 Conducts a grid search over parameters
 """
 
+import contextlib
+import csv
+import json
+from multiprocessing import Pool, shared_memory
+
 from generate import *
 
 
-def main(src_file, src_file_weighted, src_file_wpos, src_file_wneg,
-         out_file, no_progress_output,
-         n_hooks, n_lines, line_darkness, light_penalty,
-         wheel_diameter_m, wheel_pixel_size,
-         hooks, through_pixels_dict):
-
-    image_m = prepare_image(src_file, wheel_pixel_size)
-    image_w = None
-    image_w_pos = None
-    image_w_neg = None
-    line_norm_mode = LineNormalization.LENGTH
-    # image where black are weighted areas: they matter more in terms of accuracy
-    # you basically want the target black and the background white/grey
-    if src_file_weighted is not None:
-        image_w = prepare_image(src_file_weighted,
-                                wheel_pixel_size, weighting=True)
-        line_norm_mode = LineNormalization.WEIGHTED_LENGTH
-    if src_file_wpos is not None and src_file_wneg is not None:
-        image_w_pos = prepare_image(src_file_wpos,
-                                    wheel_pixel_size, weighting=True)
-        image_w_neg = prepare_image(src_file_wneg,
-                                    wheel_pixel_size, weighting=True)
-        line_norm_mode = LineNormalization.WEIGHTED_LENGTH
-
-    lines = find_lines(through_pixels_dict, n_hooks, wheel_pixel_size,
-                       image_m, n_lines=n_lines,
-                       darkness=line_darkness, lightness_penalty=light_penalty,
-                       w=image_w, w_pos=image_w_pos, w_neg=image_w_neg,
-                       line_norm_mode=line_norm_mode,
-                       line_sample_fraction=1)
-
-    save_plot([lines], [(0, 0, 0)], out_file, wheel_pixel_size, n_hooks)
-    if not no_progress_output:
-        save_plot_progress([lines], [(0, 0, 0)], out_file, wheel_pixel_size, n_hooks,
-                        np.arange(0.0, 1.0, 1.0/(n_lines//100)))
-    total_distance(lines, hooks, wheel_diameter_m, wheel_pixel_size, out_file)
-    display_output(lines, out_file)
+# parameter grid used when neither the command line nor a config file set a parameter
+DEFAULT_GRID = {
+    "hooks": [180, 360],
+    "line_w": [0.5, 0.8],
+    "lines": [4000],
+    "line_darkness": [125, 180],
+    "light_penalty": [0.5],
+    "wheel_m": [0.540],
+}
 
+# shared memory descriptors of each geometry, and the arrays attached to them, in each worker
+_shared_descriptors = {}
+_shared_arrays = {}
+_engines = {}
 
 
-if __name__ == "__main__":
-    n_hooks_vals = [180, 360]
-    line_w_milim_vals = [0.5, 0.8]
-    n_lines_vals = [4000]
-    line_darkness_vals = [125, 180]
-    light_penalty_vals = [0.5]
-    wheel_m_vals = [0.540]
-    
-    for n_hooks in n_hooks_vals:
-        for line_w_milim in line_w_milim_vals:
+def to_shared_memory(array):
+    """
+    Copies an array into a new shared memory block.
+    Returns the block (which must be kept alive and unlinked by the caller) and a descriptor that workers
+    use to attach to it (see 'from_shared_memory').
+    """
+    block = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+    return block, (block.name, array.shape, array.dtype.str)
+
+
+def from_shared_memory(descriptor):
+    """
+    Attaches to a shared memory block created by 'to_shared_memory', without copying it.
+    Returns the block and a read-only array over it.
+    """
+    name, shape, dtype = descriptor
+    block = shared_memory.SharedMemory(name=name)
+    array = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+    array.flags.writeable = False
+    return block, array
+
+
+def init_worker(shared_descriptors):
+    _shared_descriptors.update(shared_descriptors)
+
+
+def attach_geometry(key):
+    """
+    Returns the ThreadArtEngine, image and weighted images of a geometry (n_hooks, wheel_pixel_size),
+    attaching to their shared memory the first time the worker needs them.
+    """
+    if key not in _shared_arrays:
+        arrays = {}
+        for name, descriptor in _shared_descriptors[key].items():
+            arrays[name] = None if descriptor is None else from_shared_memory(descriptor)
+        _shared_arrays[key] = arrays
+        n_hooks, wheel_pixel_size = key
+        _engines[key] = ThreadArtEngine(arrays["hooks"][1], LinePixels(n_hooks, wheel_pixel_size,
+                                                                       arrays["pixels"][1], arrays["offsets"][1]))
+
+    arrays = {name: None if shared is None else shared[1] for name, shared in _shared_arrays[key].items()}
+    weights = {name: arrays[name] for name in ["w", "w_pos", "w_neg"] if arrays[name] is not None}
+
+    return _engines[key], arrays["image"], weights
+
+
+def run_config(config):
+    """
+    Runs one configuration of the grid in a worker, until it has config["target_lines"] lines.
+    If config["state_file"] is set, the run continues from that file (if it exists) and is saved back into
+    it, so later rungs of 'successive_halving' do not start over.
+    Once the configuration has all its lines, its outputs are saved into config["dst_dir"].
+    The progress output of 'find_lines' goes into a log file in the same folder.
+    Returns the row of the results table for this configuration.
+    """
+    engine, image_m, weights = attach_geometry((config["hooks"], config["wheel_p"]))
+    wheel_pixel_size = config["wheel_p"]
+    out_file = os.path.join(config["dst_dir"], "out")
+    state_file = config["state_file"]
+    finished = config["target_lines"] >= config["lines"]
+    distance = None
+
+    with open(os.path.join(config["dst_dir"], "log.txt"), 'a') as log, contextlib.redirect_stdout(log):
+        if state_file is not None and os.path.isfile(state_file):
+            state = SearchState.load(state_file)
+        else:
+            state = SearchState.new(image_m, config["hooks"])
+        engine.run(image_m, weights, {"n_lines": config["target_lines"], "darkness": config["line_darkness"],
+                                      "lightness_penalty": config["light_penalty"]}, state=state)
+        lines = state.list_of_lines
+        penalty = state.penalty
+
+        if not finished:
+            state.save(state_file)
+        else:
+            distance = round(engine.save_outputs(state, out_file, config["wheel_m"],
+                                                 config["no_progress_output"]), 2)
+            if state_file is not None and os.path.isfile(state_file):
+                os.remove(state_file)
+
+    return {"hooks": config["hooks"], "line_w": config["line_w"], "lines": config["lines"],
+            "line_darkness": config["line_darkness"], "light_penalty": config["light_penalty"],
+            "wheel_m": config["wheel_m"], "lines_drawn": len(lines) - 1, "pruned": False,
+            "avg_penalty": round(penalty / wheel_pixel_size ** 2, 4),
+            "runtime_s": round(state.elapsed, 2), "distance_m": distance, "dst_dir": config["dst_dir"]}
+
+
+def run_configs(pool, configs):
+    """
+    Runs configurations on the pool, printing each one as it finishes. Returns their results table rows.
+    """
+    results = []
+    for result in pool.imap_unordered(run_config, configs):
+        results.append(result)
+        print(f"{len(results)}/{len(configs)} done: {result['dst_dir']}, lines = {result['lines_drawn']}, "
+              f"average penalty = {result['avg_penalty']}, time = {result['runtime_s']}s")
+    return results
+
+
+def successive_halving(pool, configs, rung_lines, keep):
+    """
+    Prunes bad configurations early: runs all configurations for 'rung_lines' lines, ranks them by their
+    average penalty, and keeps only the best 'keep' fraction of them. The survivors continue from their
+    saved state for a rung 1/'keep' times longer, and so on until the remaining configurations have
+    all their lines. The saved states of pruned configurations are deleted.
+    Returns the results table rows of all configurations, marking the ones that were pruned.
+    """
+    results = []
+    alive = configs
+    rung = 0
+    while len(alive) > 0:
+        for config in alive:
+            config["target_lines"] = min(config["lines"], int(rung_lines))
+            config["state_file"] = os.path.join(config["dst_dir"], "state.npz")
+        print(f"rung {rung}: {len(alive)} configurations, up to {int(rung_lines)} lines")
+        rung_results = sorted(run_configs(pool, alive), key=lambda result: result["avg_penalty"])
+
+        n_kept = max(1, int(np.ceil(len(rung_results) * keep)))
+        for result in rung_results[n_kept:]:
+            result["pruned"] = True
+            results.append(result)
+            # pruned configurations never continue, so their state (a copy of the whole image) is not needed
+            state_file = os.path.join(result["dst_dir"], "state.npz")
+            if os.path.isfile(state_file):
+                os.remove(state_file)
+        kept_dirs = set()
+        for result in rung_results[:n_kept]:
+            if result["lines_drawn"] >= result["lines"]:
+                results.append(result)
+            else:
+                kept_dirs.add(result["dst_dir"])
+
+        alive = [config for config in alive if config["dst_dir"] in kept_dirs]
+        rung_lines /= keep
+        rung += 1
+
+    return results
+
+
+def main(src_file, src_file_weighted, src_file_wpos, src_file_wneg, dst_dir, grid,
+         no_progress_output, n_workers, cache_dir="cache", prune_lines=None, keep=1/3):
+    """
+    Runs every combination of the parameters in 'grid' over a pool of 'n_workers' processes.
+    Hooks, line pixels and prepared images are computed once per (hooks, line width) pair and shared
+    with the workers through shared memory.
+    If 'prune_lines' is set, bad configurations are pruned early (see 'successive_halving').
+    Writes a results table, sorted by final average penalty, into 'dst_dir'/results.csv.
+    """
+    shared_blocks = []
+    shared_descriptors = {}
+    configs = []
+
+    for n_hooks in grid["hooks"]:
+        n_hooks = max(3, n_hooks)
+        max_lines = int((n_hooks-1)*(n_hooks/2))
+        for line_w_milim in grid["line_w"]:
             line_w_m = line_w_milim / 1000      # line width in meters
             wheel_p = int(1 / line_w_m)         # diameter (in pixels) of thread portrait
-            hooks = generate_hooks(n_hooks, wheel_p)
-            through_pixels_dict = build_through_pixels_dict(
-                hooks, n_hooks, wheel_p)
-            
-            for n_lines in n_lines_vals:
-                for line_darkness in line_darkness_vals:
-                    for light_penalty in light_penalty_vals:
-                        for wheel_m in wheel_m_vals:
-                            dst_dir = "out_"+str(n_hooks)+"_"+str(line_w_milim)+"_"+str(n_lines)+"_"+str(line_darkness)+"_"+str(light_penalty)+"_"+str(wheel_m)
-                            os.mkdir(dst_dir)
-                            main(os.path.join("CheHigh", "che2.png"), None, os.path.join("CheHigh", "che_wpos.png"), os.path.join("CheHigh", "che_wneg.png"),
-                                 os.path.join(dst_dir, "out"),
-                                 False, n_hooks, n_lines, line_darkness, light_penalty, wheel_m, wheel_p,
-                                 hooks, through_pixels_dict)
+            hooks, line_pixels = load_geometry(n_hooks, wheel_p, cache_dir)
+
+            with image_cache([src_file, src_file_weighted, src_file_wpos, src_file_wneg]):
+                arrays = {"hooks": hooks, "pixels": line_pixels.pixels, "offsets": line_pixels.offsets,
+                          "image": prepare_image(src_file, wheel_p), "w": None, "w_pos": None, "w_neg": None}
+                if src_file_weighted is not None:
+                    arrays["w"] = prepare_image(src_file_weighted, wheel_p, weighting=True)
+                if src_file_wpos is not None and src_file_wneg is not None:
+                    arrays["w_pos"] = prepare_image(src_file_wpos, wheel_p, weighting=True)
+                    arrays["w_neg"] = prepare_image(src_file_wneg, wheel_p, weighting=True)
+
+            descriptors = {}
+            for name, array in arrays.items():
+                descriptors[name] = None
+                if array is not None:
+                    block, descriptors[name] = to_shared_memory(np.ascontiguousarray(array))
+                    shared_blocks.append(block)
+            shared_descriptors[(n_hooks, wheel_p)] = descriptors
+
+            for n_lines, line_darkness, light_penalty, wheel_m in product(
+                    grid["lines"], grid["line_darkness"], grid["light_penalty"], grid["wheel_m"]):
+                config_dir = os.path.join(dst_dir, "out_"+str(n_hooks)+"_"+str(line_w_milim)+"_"+str(n_lines) +
+                                          "_"+str(line_darkness)+"_"+str(light_penalty)+"_"+str(wheel_m))
+                os.makedirs(config_dir, exist_ok=True)
+                configs.append({"hooks": n_hooks, "line_w": line_w_milim, "wheel_p": wheel_p,
+                                "lines": max(1, min(n_lines, max_lines)), "line_darkness": line_darkness,
+                                "light_penalty": light_penalty, "wheel_m": wheel_m, "dst_dir": config_dir,
+                                "no_progress_output": no_progress_output,
+                                "target_lines": max(1, min(n_lines, max_lines)), "state_file": None})
+
+    print(f"running {len(configs)} configurations on {n_workers} workers")
+    try:
+        with Pool(n_workers, initializer=init_worker, initargs=(shared_descriptors,)) as pool:
+            if prune_lines is None:
+                results = run_configs(pool, configs)
+            else:
+                results = successive_halving(pool, configs, prune_lines, keep)
+    finally:
+        for block in shared_blocks:
+            block.close()
+            block.unlink()
+
+    # finished configurations first, then the ones pruned last
+    results.sort(key=lambda result: (-result["lines_drawn"], result["avg_penalty"]))
+    results_file = os.path.join(dst_dir, "results.csv")
+    with open(results_file, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=list(results[0].keys()))
+        writer.writeheader()
+        writer.writerows(results)
+    print("results saved to " + results_file)
+
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='''Runs generate.py over a grid of parameters in parallel, and saves a table \
+            comparing the results. Each parameter takes a list of values.'''
+    )
+    parser.add_argument('src', help='''Source file (.jpg, .png, ...)''')
+    parser.add_argument('--dst_dir', default=".", dest='dst_dir',
+                        help='''Folder to output configuration folders and results.csv into''')
+    parser.add_argument('--config', default=None, dest='config',
+                        help='''JSON file mapping parameter names (hooks, line_w, lines, line_darkness, \
+                            light_penalty, wheel_m) to lists of values; overrides the command line''')
+    for name, value_type in [("hooks", int), ("line_w", float), ("lines", int),
+                             ("line_darkness", int), ("light_penalty", float), ("wheel_m", float)]:
+        parser.add_argument('--' + name, type=value_type, nargs='+', default=DEFAULT_GRID[name], dest=name,
+                            help=f'''Values of --{name} to try (default: {DEFAULT_GRID[name]})''')
+    group_w = parser.add_mutually_exclusive_group()
+    group_w.add_argument('--weighted', default=None, dest='weighted',
+                         help='''A secondary image with more important zones having dark masks''')
+    group_w.add_argument('--dual_weighted', default=[None, None], dest='dual_weighted', nargs=2,
+                         help='''Two secondary images, with first (wpos) having important zones with dark masks and second (wneg) having clear zones with dark masks''')
+    parser.add_argument('--no_progress_output', action='store_true', dest='no_progress_output',
+                        help='''Whether to create progress images every 100 lines (default: True)''')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), dest='workers',
+                        help='''Amount of parallel processes (default: amount of CPUs)''')
+    parser.add_argument('--cache_dir', default="cache", dest='cache_dir',
+                        help='''Folder where hooks and line pixels are cached between runs (default: cache)''')
+    parser.add_argument('--prune_lines', type=int, default=None, dest='prune_lines',
+                        help='''Whether to prune bad configurations early, ranking them every time they draw this amount of lines (and growing it each time)''')
+    parser.add_argument('--keep', type=float, default=1/3, dest='keep',
+                        help='''Fraction (0,1) of configurations kept each time they are ranked, with --prune_lines (default: 0.33)''')
+    args = parser.parse_args()
+
+    if file_path_invalid(args.src) or \
+            file_path_invalid(args.weighted) or \
+            file_path_invalid(args.dual_weighted[0]) or \
+            file_path_invalid(args.dual_weighted[1]) or \
+            file_path_invalid(args.config):
+        exit(0)
+    grid = {name: getattr(args, name) for name in DEFAULT_GRID}
+    if args.config is not None:
+        with open(args.config) as f:
+            grid.update(json.load(f))
+    os.makedirs(args.dst_dir, exist_ok=True)
+
+    main(args.src, args.weighted, args.dual_weighted[0], args.dual_weighted[1], args.dst_dir, grid,
+         args.no_progress_output, max(1, args.workers), args.cache_dir,
+         None if args.prune_lines is None else max(1, args.prune_lines), max(0.01, min(0.99, args.keep)))
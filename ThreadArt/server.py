@@ -0,0 +1,339 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Local HTTP server that queues generate.py jobs and runs them on a pool of warm workers
+"""
+
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing import Queue
+
+from generate import *
+
+
+# generate.py parameters a job can set, and their defaults
+JOB_DEFAULTS = {
+    "weighted": None,
+    "dual_weighted": [None, None],
+    "hooks": 360,
+    "lines": 2500,
+    "line_w": 0.7,
+    "line_darkness": 125,
+    "light_penalty": 0.5,
+    "wheel_m": 0.540,
+    "incremental": False,
+    "multires_levels": 0,
+    "multires_top_k": 10,
+    "min_fitness": None,
+    "min_improvement": None,
+    "improvement_window": 100,
+    "time_budget": None,
+    "workers": 1,
+    "pregather_weights": False,
+    "line_sample_fraction": 1,
+    "sample_policy": "random",
+    "sample_top_k": 20,
+    "seed": None,
+    "precision": "double",
+    "disk_only": False,
+    "no_progress_output": True,
+    "progress_format": "jpg",
+}
+
+# queue for progress updates, and the engines of each geometry, in each worker
+_progress_queue = None
+_engines = {}
+
+
+def job_config(request, cache_dir):
+    """
+    Validates a job request (a dict with the source file in "src" and any of the keys of JOB_DEFAULTS), and
+    sanitizes it the same way as the generate.py command line.
+    Returns the configuration of the job, or raises ValueError.
+    """
+    unknown = set(request) - set(JOB_DEFAULTS) - {"src"}
+    if len(unknown) > 0:
+        raise ValueError("Unknown parameters: " + ", ".join(sorted(unknown)))
+    if "src" not in request:
+        raise ValueError("Missing source file (src)")
+    request = dict(JOB_DEFAULTS, **request)
+    if request["weighted"] is not None and not isinstance(request["weighted"], str):
+        raise ValueError("weighted must be a file path")
+    if not isinstance(request["dual_weighted"], (list, tuple)) or len(request["dual_weighted"]) != 2 or \
+            not (all(file_path is None for file_path in request["dual_weighted"]) or
+                 all(isinstance(file_path, str) for file_path in request["dual_weighted"])):
+        raise ValueError("dual_weighted must be a list of two file paths (wpos and wneg)")
+    if request["weighted"] is not None and request["dual_weighted"][0] is not None:
+        raise ValueError("weighted and dual_weighted cannot be used together")
+    for file_path in [request["src"], request["weighted"]] + list(request["dual_weighted"]):
+        if file_path is not None and not os.path.isfile(file_path):
+            raise ValueError("File " + file_path + " not found")
+    if request["precision"] not in ["double", "single", "compact"]:
+        raise ValueError("Unknown precision " + str(request["precision"]))
+    if request["sample_policy"] not in ["random", "adaptive"]:
+        raise ValueError("Unknown sample policy " + str(request["sample_policy"]))
+    if request["progress_format"] not in ["jpg", "frames", "gif", "webp"]:
+        raise ValueError("Unknown progress format " + str(request["progress_format"]))
+
+    n_hooks = max(3, int(request["hooks"]))
+    max_lines = int((n_hooks-1)*(n_hooks/2))
+    n_lines = max(1, min(int(request["lines"]), max_lines))
+    line_w_m = max(0.01, float(request["line_w"])) / 1000      # line width in meters
+    return {
+        "src": request["src"], "weighted": request["weighted"],
+        "wpos": request["dual_weighted"][0], "wneg": request["dual_weighted"][1],
+        "hooks": n_hooks, "wheel_p": int(1 / line_w_m), "wheel_m": max(0.1, float(request["wheel_m"])),
+        "cache_dir": cache_dir, "precision": request["precision"], "disk_only": bool(request["disk_only"]),
+        "no_progress_output": bool(request["no_progress_output"]), "progress_format": request["progress_format"],
+        "seed": None if request["seed"] is None else int(request["seed"]),
+        "params": {"n_lines": n_lines, "darkness": max(0, min(255, int(request["line_darkness"]))),
+                   "lightness_penalty": max(0, min(1, float(request["light_penalty"]))),
+                   "incremental": bool(request["incremental"]),
+                   "multires_levels": max(0, int(request["multires_levels"])),
+                   "multires_top_k": max(1, int(request["multires_top_k"])),
+                   "min_fitness": None if request["min_fitness"] is None else float(request["min_fitness"]),
+                   "min_improvement": None if request["min_improvement"] is None else
+                   float(request["min_improvement"]),
+                   "improvement_window": max(1, int(request["improvement_window"])),
+                   "time_budget": None if request["time_budget"] is None else float(request["time_budget"]),
+                   "workers": max(1, int(request["workers"])),
+                   "pregather_weights": bool(request["pregather_weights"]),
+                   "line_sample_fraction": max(0.001, min(1, float(request["line_sample_fraction"]))),
+                   "sample_policy": request["sample_policy"], "sample_top_k": max(1, int(request["sample_top_k"]))},
+    }
+
+
+def server_engine(n_hooks, wheel_pixel_size, cache_dir, disk_only=False, precision="double"):
+    """
+    ThreadArtEngine of a geometry in this worker, loaded the first time a job needs it.
+    """
+    key = (n_hooks, wheel_pixel_size, cache_dir, disk_only, precision)
+    if key not in _engines:
+        _engines[key] = ThreadArtEngine.load(n_hooks, wheel_pixel_size, cache_dir, disk_only=disk_only,
+                                             precision=precision)
+    return _engines[key]
+
+
+def init_server_worker(progress_queue, cache_dir, warm_geometries):
+    global _progress_queue
+    _progress_queue = progress_queue
+    for n_hooks, wheel_pixel_size in warm_geometries:
+        server_engine(n_hooks, wheel_pixel_size, cache_dir)
+
+
+def run_job(job_id, config):
+    """
+    Draws the portrait of a job in a worker, sending its progress to the server, and logging the progress
+    output of 'find_lines' into the job folder. Returns the result of the job.
+    """
+    engine = server_engine(config["hooks"], config["wheel_p"], config["cache_dir"], config["disk_only"],
+                           config["precision"])
+    _progress_queue.put((job_id, {"state": "running"}))
+    if config["seed"] is not None:
+        np.random.seed(config["seed"])
+
+    def progress(lines, n_lines, avg_penalty, seconds_left):
+        _progress_queue.put((job_id, {"lines": lines, "avg_penalty": round(avg_penalty, 4),
+                                      "eta_s": round(seconds_left, 1)}))
+
+    out_file = os.path.join(config["dst_dir"], "out")
+    with open(os.path.join(config["dst_dir"], "log.txt"), 'a') as log, contextlib.redirect_stdout(log):
+        state = draw_portrait(engine, config["src"], config["weighted"], config["wpos"], config["wneg"],
+                              out_file, config["no_progress_output"], config["wheel_m"],
+                              dict(config["params"], progress_callback=progress), checkpoint_interval=0,
+                              progress_format=config["progress_format"])
+
+    return {"lines": len(state.list_of_lines) - 1,
+            "avg_penalty": round(state.penalty / engine.wheel_pixel_size ** 2, 4),
+            "stop_reason": state.stop_reason, "runtime_s": round(state.elapsed, 2),
+            "hook_sequence": [line[1] for line in state.list_of_lines], "image": out_file + ".jpg"}
+
+
+class JobServer:
+    """
+    Queue of jobs run on a pool of 'n_workers' processes. Each worker keeps a ThreadArtEngine per geometry,
+    loading the 'warm_geometries' ((n_hooks, wheel_pixel_size) pairs) as soon as it starts, so jobs do not
+    pay for imports or geometry setup.
+    Jobs are kept in memory as dicts describing their status, which are updated as workers send progress.
+    Their outputs go into their own folder in 'dst_dir'.
+    """
+
+    def __init__(self, dst_dir, n_workers, cache_dir="cache", warm_geometries=()):
+        self.dst_dir = dst_dir
+        self.cache_dir = cache_dir
+        self.jobs = {}
+        self.condition = threading.Condition()
+
+        # build the geometry caches once, before the workers load them
+        for n_hooks, wheel_pixel_size in warm_geometries:
+            load_geometry(n_hooks, wheel_pixel_size, cache_dir)
+        self.progress_queue = Queue()
+        self.pool = Pool(n_workers, initializer=init_server_worker,
+                         initargs=(self.progress_queue, cache_dir, list(warm_geometries)))
+        self.progress_thread = threading.Thread(target=self.read_progress, daemon=True)
+        self.progress_thread.start()
+
+    def submit(self, request):
+        """
+        Queues a job request (see 'job_config'). Returns the status of the new job.
+        """
+        config = job_config(request, self.cache_dir)
+        with self.condition:
+            job_id = str(len(self.jobs) + 1)
+            config["dst_dir"] = os.path.join(self.dst_dir, job_id)
+            os.makedirs(config["dst_dir"], exist_ok=True)
+            self.jobs[job_id] = {"id": job_id, "state": "queued", "lines": 0,
+                                 "n_lines": config["params"]["n_lines"], "avg_penalty": None, "eta_s": None,
+                                 "dst_dir": config["dst_dir"], "version": 0}
+            status = dict(self.jobs[job_id])
+        self.pool.apply_async(run_job, (job_id, config),
+                              callback=lambda result: self.update(job_id, dict(result, state="done", eta_s=0)),
+                              error_callback=lambda error: self.update(job_id, {"state": "failed",
+                                                                                "error": repr(error)}))
+        return status
+
+    def update(self, job_id, changes):
+        with self.condition:
+            job = self.jobs[job_id]
+            # progress can arrive after the job finished, but its state only moves forward
+            if changes.get("state") == "running" and job["state"] != "queued":
+                changes = {key: value for key, value in changes.items() if key != "state"}
+            if job["state"] in ["done", "failed"] and "state" not in changes:
+                return
+            job.update(changes)
+            job["version"] += 1
+            self.condition.notify_all()
+
+    def read_progress(self):
+        while True:
+            job_id, changes = self.progress_queue.get()
+            self.update(job_id, changes)
+
+    def status(self, job_id, version=None, timeout=None):
+        """
+        Status of a job, or None if it does not exist.
+        If 'version' is given, waits (up to 'timeout' seconds) until the job has a newer status first.
+        """
+        with self.condition:
+            if job_id not in self.jobs:
+                return None
+            if version is not None:
+                self.condition.wait_for(lambda: self.jobs[job_id]["version"] != version, timeout)
+            return dict(self.jobs[job_id])
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+
+
+class JobRequestHandler(BaseHTTPRequestHandler):
+    """
+    HTTP interface of a JobServer:
+     POST /jobs                 queues a job from a JSON request (see 'job_config'), returns its status
+     GET  /jobs                 statuses of all jobs
+     GET  /jobs/<id>            status of a job: state, lines, average penalty and ETA, and its results
+                                    (hook sequence, ...) once done
+     GET  /jobs/<id>/events     streams the status of a job as JSON lines, every time it changes, until it ends
+     GET  /jobs/<id>/image      output image of a finished job
+    """
+
+    def send_json(self, code, body):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        if self.path.rstrip("/") != "/jobs":
+            return self.send_json(404, {"error": "Not found"})
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            status = self.server.job_server.submit(request)
+        except (ValueError, TypeError) as e:
+            return self.send_json(400, {"error": str(e)})
+        self.send_json(202, status)
+
+    def do_GET(self):
+        job_server = self.server.job_server
+        parts = self.path.strip("/").split("/")
+        if parts == ["jobs"]:
+            return self.send_json(200, [job_server.status(job_id) for job_id in list(job_server.jobs)])
+        if len(parts) < 2 or len(parts) > 3 or parts[0] != "jobs":
+            return self.send_json(404, {"error": "Not found"})
+        status = job_server.status(parts[1])
+        if status is None:
+            return self.send_json(404, {"error": "No job " + parts[1]})
+
+        if len(parts) == 2:
+            self.send_json(200, status)
+        elif parts[2] == "events":
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.end_headers()
+            while True:
+                self.wfile.write((json.dumps(status) + "\n").encode())
+                self.wfile.flush()
+                if status["state"] in ["done", "failed"]:
+                    break
+                status = job_server.status(parts[1], status["version"], timeout=30)
+        elif parts[2] == "image":
+            if status["state"] != "done":
+                return self.send_json(409, {"error": "Job " + parts[1] + " is " + status["state"]})
+            with open(status["image"], 'rb') as f:
+                data = f.read()
+            self.send_response(200)
+            self.send_header("Content-Type", "image/jpeg")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        else:
+            self.send_json(404, {"error": "Not found"})
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main(host, port, dst_dir, n_workers, cache_dir="cache", warm_geometries=()):
+    job_server = JobServer(dst_dir, n_workers, cache_dir, warm_geometries)
+    http_server = ThreadingHTTPServer((host, port), JobRequestHandler)
+    http_server.job_server = job_server
+    print(f"serving on http://{host}:{http_server.server_address[1]} with {n_workers} workers")
+    try:
+        http_server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        http_server.server_close()
+        job_server.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='''Serves generate.py jobs over HTTP on this machine. Jobs are JSON objects with the source \
+            file in "src" and any generate.py parameter, e.g. {"src": "example.jpg", "weighted": "example_weighted.jpg", \
+            "lines": 3000}.'''
+    )
+    parser.add_argument('--host', default="127.0.0.1", dest='host',
+                        help='''Address to listen on (default: 127.0.0.1)''')
+    parser.add_argument('--port', type=int, default=8765, dest='port',
+                        help='''Port to listen on (default: 8765)''')
+    parser.add_argument('--dst_dir', default="jobs", dest='dst_dir',
+                        help='''Folder to output the files of each job into''')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), dest='workers',
+                        help='''Amount of parallel processes (default: amount of CPUs)''')
+    parser.add_argument('--cache_dir', default="cache", dest='cache_dir',
+                        help='''Folder where hooks and line pixels are cached between runs (default: cache)''')
+    parser.add_argument('--warm', type=float, nargs=2, action='append', default=None, dest='warm',
+                        metavar=('HOOKS', 'LINE_W'),
+                        help='''Amount of hooks and line width whose line pixels workers load on start (default: 360 0.7)''')
+    args = parser.parse_args()
+
+    os.makedirs(args.dst_dir, exist_ok=True)
+    warm = [(360, 0.7)] if args.warm is None else args.warm
+    warm_geometries = [(max(3, int(n_hooks)), int(1 / (max(0.01, line_w) / 1000))) for n_hooks, line_w in warm]
+
+    main(args.host, args.port, args.dst_dir, max(1, args.workers), args.cache_dir, warm_geometries)
@@ -6,14 +6,25 @@ This script was adapted from the one in https://github.com/callummcdougall/compu
 """
 
 import numpy as np
-from itertools import product
 from PIL import Image, ImageDraw
 import matplotlib.pyplot as plt
 import time
 import argparse
 import os
+import shutil
+import json
+import contextlib
+import cProfile
+import tracemalloc
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from collections import deque
 from enum import Enum
 
+# bump whenever 'build_line_pixels' changes which pixels a line runs through, to invalidate cached geometry
+RASTERIZER_VERSION = 1
+
 class LineNormalization(Enum):
     NONE = 1
     LENGTH = 2
@@ -35,58 +46,296 @@ def generate_hooks(n_hooks, wheel_pixel_size):
     return np.array((x, y)).T
 
 
-def through_pixels(p0, p1):
+def range_indices(offsets, ids):
     """
-    Given 2 hooks, generates a list of pixels that the line connecting them runs through.
+    Indices of the concatenated ranges offsets[i]:offsets[i+1] for every i in 'ids', without Python loops.
+    Returns the indices and the index where each range starts in them.
     """
-    x_diff = p0[0]-p1[0]
-    y_diff = p0[1]-p1[1]
-    eucl_dist = np.sqrt(x_diff*x_diff + y_diff*y_diff)
-    d = max(int(eucl_dist), 1)
+    range_starts = offsets[ids]
+    lengths = offsets[ids + 1] - range_starts
+    starts = np.concatenate(([0], np.cumsum(lengths)[:-1])).astype(np.int64)
+    indices = np.arange(lengths.sum()) + np.repeat(range_starts - starts, lengths)
 
-    pixels = p0 + (p1-p0) * np.array([np.arange(d+1), np.arange(d+1)]).T / d
-    pixels = np.unique(np.round(pixels), axis=0).astype(int)
+    return indices, starts
 
-    return pixels
 
+def gather_ranges(values, offsets, ids):
+    """
+    Concatenates the ranges values[offsets[i]:offsets[i+1]] for every i in 'ids' (see 'range_indices').
+    Returns the concatenated values and the index where each range starts in them.
+    """
+    indices, starts = range_indices(offsets, ids)
+    return values[indices], starts
 
-def build_through_pixels_dict(hooks, n_hooks, wheel_pixel_size):
+
+class LinePixels:
     """
-    Uses 'through_pixels' to build up a dictionary of all possible lines connecting 2 hooks.
-    Can be run at the start of a project, and doesn't need to be run again.
-    Prints out an ongoing estimate of how much time is left.
+    Compact store of the pixels that every line connecting 2 hooks runs through.
+    All pixels are kept as linear indices (x * wheel_pixel_size + y) in a single flat int32 array,
+    one line after the other, and 'offsets' holds where each line starts (CSR layout).
+    Lines are indexed by a pair id computed from their hooks (see 'pair_id'); lines that were
+    not built are empty.
+    If 'disk' is set, pixels are instead indices into images packed with 'pack_disk' (see 'to_disk').
     """
-    ignore_next_hooks = 10
 
+    def __init__(self, n_hooks, wheel_pixel_size, pixels, offsets, disk=None):
+        self.n_hooks = n_hooks
+        self.wheel_pixel_size = wheel_pixel_size
+        self.pixels = pixels
+        self.offsets = offsets
+        self.disk = disk
+        self._inverted = None
+
+    @property
+    def n_pixels(self):
+        """
+        Size of the (flattened or packed) images the pixels index into.
+        """
+        return self.wheel_pixel_size ** 2 if self.disk is None else len(self.disk)
+
+    @staticmethod
+    def pair_id(i, j):
+        """
+        Id of the line connecting hooks i and j, regardless of their order.
+        Works with both integers and arrays of hooks.
+        """
+        i, j = np.minimum(i, j), np.maximum(i, j)
+        return j * (j - 1) // 2 + i
+
+    def __getitem__(self, line):
+        """
+        Linear indices of the pixels of a line, given as a pair of hooks.
+        """
+        pair = self.pair_id(line[0], line[1])
+        return self.pixels[self.offsets[pair]:self.offsets[pair + 1]]
+
+    def gather(self, pair_ids):
+        """
+        Concatenates the pixels of several lines (given by their pair ids) into a single buffer.
+        Returns the buffer and the index where each line starts in it.
+        """
+        return gather_ranges(self.pixels, self.offsets, pair_ids)
+
+    def invert(self):
+        """
+        Builds the inverted index of the store: for each pixel, the pair ids of all lines running
+        through it. Returns it in the same CSR layout, as a flat array of pair ids and its offsets.
+        The index is only built once per store.
+        """
+        if self._inverted is not None:
+            return self._inverted
+
+        pair_ids = np.repeat(np.arange(len(self.offsets) - 1, dtype=np.int32), np.diff(self.offsets))
+        order = np.argsort(self.pixels, kind="stable")
+        offsets = np.zeros(self.n_pixels + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(self.pixels, minlength=self.n_pixels))
+
+        self._inverted = (pair_ids[order], offsets)
+        return self._inverted
+
+    def to_disk(self, disk, file_name):
+        """
+        Copy of the store indexing images packed with 'pack_disk' instead of flattened ones, saved as the .npy
+        file 'file_name' a chunk at a time and loaded memory-mapped (read-only), like the cached store.
+        Every line runs inside the wheel, so no pixel is lost.
+        The file is written next to 'file_name' first and then renamed, so other processes never see half of it.
+        """
+        tmp_file_name = f"{file_name}.tmp{os.getpid()}.npy"
+        pixels = np.lib.format.open_memmap(tmp_file_name, mode="w+", dtype=np.int32, shape=self.pixels.shape)
+        # 'disk' is sorted, so packed indices can be searched instead of looked up in a table of every pixel
+        for chunk in chunks(len(self.pixels)):
+            pixels[chunk] = np.searchsorted(disk, self.pixels[chunk])
+        pixels.flush()
+        del pixels
+        os.replace(tmp_file_name, file_name)
+        return LinePixels(self.n_hooks, self.wheel_pixel_size, np.load(file_name, mmap_mode="r"), self.offsets,
+                          disk)
+
+    @property
+    def nbytes(self):
+        return self.pixels.nbytes + self.offsets.nbytes
+
+
+def build_line_pixels(hooks, n_hooks, wheel_pixel_size, ignore_next_hooks=10):
+    """
+    Builds up a LinePixels store of all possible lines connecting 2 hooks. Each line runs through the pixels
+    of evenly spaced points between its hooks, one per pixel of its length, rounded and without repeats.
+    Changing which pixels these are must bump RASTERIZER_VERSION, so cached geometry is rebuilt.
+    Lines are rasterized in batches, one batch for all lines with the same amount of points.
+    Can be run at the start of a project, and doesn't need to be run again (see 'load_geometry').
+    Prints out an ongoing estimate of how much time is left (at most twice per second).
+    """
     l = [(0, 1)]
     for j in range(n_hooks):
         for i in range(j):
             # only make links to hooks that are further than 'ignore_next_hooks' away
             if j-i > ignore_next_hooks and j-i < (n_hooks - ignore_next_hooks):
                 l.append((i, j))
+    l = np.array(l)
 
-    # list of all indices in a random order
-    links_count = len(l)
-    random_order = np.random.choice(links_count, links_count, replace=False)
-    # why do we need this in random order?
+    p0, p1 = hooks[l[:, 0]], hooks[l[:, 1]]
+    x_diff = p0[:, 0] - p1[:, 0]
+    y_diff = p0[:, 1] - p1[:, 1]
+    d = np.maximum(np.sqrt(x_diff*x_diff + y_diff*y_diff).astype(int), 1)
 
-    through_pixels_dict = {}
+    links_count = len(l)
+    lengths = np.zeros(links_count, dtype=np.int64)
+    batch_links = []
+    batch_pixels = []
     t0 = time.time()
+    t_print = t0
+
+    for length in np.unique(d):
+        links = np.flatnonzero(d == length)
+        steps = np.arange(length + 1)
+        pixels = p0[links, None, :] + (p1 - p0)[links, None, :] * steps[None, :, None] / length
+        pixels = np.round(pixels).astype(int)
+        pixels = np.sort(pixels[:, :, 0] * wheel_pixel_size + pixels[:, :, 1], axis=1)
+
+        # rounding only repeats pixels next to each other, so dropping consecutive repeats is enough
+        keep = np.ones(pixels.shape, dtype=bool)
+        keep[:, 1:] = pixels[:, 1:] != pixels[:, :-1]
+        batch_links.append(links)
+        batch_pixels.append(pixels[keep].astype(np.int32))
+        lengths[links] = keep.sum(axis=1)
+
+        if time.time() - t_print > 0.5:
+            t_print = time.time()
+            done = sum(len(links) for links in batch_links)
+            t_left = (t_print - t0) * (links_count - done) / done
+            print(
+                f"time left = {time.strftime('%M:%S', time.gmtime(t_left))}", end="\r")
+
+    # move the pixels of each line from the order they were rasterized in to the order of their pair ids
+    n_pairs = LinePixels.pair_id(n_hooks - 2, n_hooks - 1) + 1
+    pair_ids = LinePixels.pair_id(l[:, 0], l[:, 1])
+    batch_links = np.concatenate(batch_links)
+    link_starts = np.zeros(links_count, dtype=np.int64)
+    link_starts[batch_links] = np.concatenate(([0], np.cumsum(lengths[batch_links])[:-1]))
+
+    pair_lengths = np.zeros(n_pairs, dtype=np.int64)
+    pair_lengths[pair_ids] = lengths
+    pair_starts = np.zeros(n_pairs, dtype=np.int64)
+    pair_starts[pair_ids] = link_starts
+    offsets = np.zeros(n_pairs + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(pair_lengths)
+    indices = np.arange(offsets[-1]) + np.repeat(pair_starts - offsets[:-1], pair_lengths)
+
+    return LinePixels(n_hooks, wheel_pixel_size, np.concatenate(batch_pixels)[indices], offsets)
+
+
+def geometry_cache_path(cache_dir, n_hooks, wheel_pixel_size, ignore_next_hooks=10):
+    """
+    Folder where the hooks and line pixels for a given geometry are cached.
+    """
+    return os.path.join(cache_dir, f"hooks{n_hooks}_px{wheel_pixel_size}_ignore{ignore_next_hooks}"
+                                   f"_v{RASTERIZER_VERSION}")
 
-    for n in range(links_count):
-        (i, j) = l[random_order[n]]
-        p0, p1 = hooks[i], hooks[j]
-        through_pixels_dict[(i, j)] = through_pixels(p0, p1)
 
-        t = time.time() - t0
-        t_left = t * (links_count - n - 1) / (n + 1)
-        print(
-            f"time left = {time.strftime('%M:%S', time.gmtime(t_left))}", end="\r")
+def load_geometry(n_hooks, wheel_pixel_size, cache_dir, ignore_next_hooks=10, rebuild=False, disk_only=False):
+    """
+    Returns the hooks and the LinePixels store for a given geometry, building them only if they are not
+    in 'cache_dir' yet (or if 'rebuild' is True).
+    Arrays are saved as .npy files and loaded memory-mapped (read-only), so later runs start almost
+    immediately and parallel processes share the same pages through the OS page cache.
+    If 'disk_only' is True, the store indexes images packed with 'pack_disk' (see 'LinePixels.to_disk'), and
+    is cached the same way, the first time it is needed.
+    """
+    path = geometry_cache_path(cache_dir, n_hooks, wheel_pixel_size, ignore_next_hooks)
+    if rebuild and os.path.isdir(path):
+        shutil.rmtree(path)
+
+    if not os.path.isdir(path):
+        print("building line pixels for " + path)
+        hooks = generate_hooks(n_hooks, wheel_pixel_size)
+        line_pixels = build_line_pixels(hooks, n_hooks, wheel_pixel_size, ignore_next_hooks)
+        print()
+
+        # write everything into a temporary folder and rename it, so other processes never see half a cache
+        tmp_path = f"{path}.tmp{os.getpid()}"
+        os.makedirs(tmp_path, exist_ok=True)
+        np.save(os.path.join(tmp_path, "hooks.npy"), hooks)
+        np.save(os.path.join(tmp_path, "pixels.npy"), line_pixels.pixels)
+        np.save(os.path.join(tmp_path, "offsets.npy"), line_pixels.offsets)
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # another process cached the same geometry in the meantime
+            shutil.rmtree(tmp_path)
+
+    hooks = np.load(os.path.join(path, "hooks.npy"))
+    pixels = np.load(os.path.join(path, "pixels.npy"), mmap_mode="r")
+    offsets = np.load(os.path.join(path, "offsets.npy"), mmap_mode="r")
+    line_pixels = LinePixels(n_hooks, wheel_pixel_size, pixels, offsets)
+
+    if disk_only:
+        # only pixels inside the wheel can be crossed by lines, so the corners are dropped from every image
+        disk = disk_pixels(wheel_pixel_size)
+        disk_file = os.path.join(path, "pixels_disk.npy")
+        if os.path.isfile(disk_file):
+            line_pixels = LinePixels(n_hooks, wheel_pixel_size, np.load(disk_file, mmap_mode="r"), offsets, disk)
+        else:
+            line_pixels = line_pixels.to_disk(disk, disk_file)
+
+    return hooks, line_pixels
+
+
+def clear_geometry_cache(cache_dir):
+    """
+    Deletes every cached geometry in 'cache_dir'.
+    """
+    if os.path.isdir(cache_dir):
+        shutil.rmtree(cache_dir)
+        print("Cleared cache " + cache_dir)
+
+
+def load_image(file_name, wheel_pixel_size):
+    """
+    Opens an image file and resizes it to a square of 'wheel_pixel_size' pixels.
+    JPEGs much larger than that are decoded directly at a reduced scale (still at least twice 'wheel_pixel_size',
+    so resizing keeps its quality), which is much faster than decoding every pixel of a photo only to shrink it.
+    Within an 'image_cache' block, images are kept while the file is unchanged, so a file used in several roles
+    is only loaded once.
+    """
+    if _image_cache is None:
+        return _load_image(file_name, wheel_pixel_size)
+    key = (os.path.abspath(file_name), os.path.getmtime(file_name), wheel_pixel_size)
+    if key not in _image_cache:
+        _image_cache[key] = _load_image(file_name, wheel_pixel_size)
+    return _image_cache[key]
 
-    return through_pixels_dict
 
+# images kept by 'load_image' inside an 'image_cache' block, None outside
+_image_cache = None
 
-def prepare_image(file_name, wheel_pixel_size, colour=False, weighting=False):
+
+@contextlib.contextmanager
+def image_cache(file_names):
+    """
+    Keeps the images loaded by 'load_image' until the end of the block, if some of 'file_names' (the files about to
+    be loaded, or None) are the same file, so it is only loaded once. Resized images of very thin lines take
+    hundreds of MB each, so they are not kept any longer than that, nor at all when every file is different.
+    """
+    global _image_cache
+    file_names = [os.path.abspath(file_name) for file_name in file_names if file_name is not None]
+    if _image_cache is not None or len(set(file_names)) == len(file_names):
+        # nested blocks are cleared by the outer one
+        yield
+        return
+    _image_cache = {}
+    try:
+        yield
+    finally:
+        _image_cache = None
+
+
+def _load_image(file_name, wheel_pixel_size):
+    image = Image.open(file_name)
+    image.draft(image.mode, (2*wheel_pixel_size, 2*wheel_pixel_size))
+    return image.resize((wheel_pixel_size, wheel_pixel_size))
+
+
+def prepare_image(file_name, wheel_pixel_size, colour=False, weighting=False, precision="double", scratch_dir=None):
     """
     Takes a jpeg or png image file, and converts it into a square array of bytes.
     'colour' (boolean) determines whether image is meant to have its colour read rather than darkness.
@@ -95,43 +344,190 @@ def prepare_image(file_name, wheel_pixel_size, colour=False, weighting=False):
     'weighting' (boolean) determines whether image is meant to be an importance weighting. If True,
     the array has values between 0 and 1, where black = 1 = maximum importance, and white = 0 = no importance).
     if both are false, image returned is array of pixels, [0, 255] where 255 is BLACK and 0 is WHITE
+    'precision' sets the dtypes of the arrays: "double" (int64 images and float64 weightings), "single"
+    (int16 images and float32 weightings) or "compact" (int16 images and uint8 weightings, where 255 is
+    maximum importance; use 'weight_values' to read them).
+    The array is written a chunk at a time, into a scratch array (see 'scratch_array') if 'scratch_dir' is given.
     """
-    image = Image.open(file_name).resize((wheel_pixel_size, wheel_pixel_size))
+    image = load_image(file_name, wheel_pixel_size)
 
+    # 8 bit values are converted with a lookup table straight into the final dtype
     if colour:
-        image = np.array(image.convert(mode="HSV").getdata()).reshape(
-            (wheel_pixel_size, wheel_pixel_size, 3))[:, :, 1]
+        table = np.arange(256, dtype=np.int64 if precision == "double" else np.int16)
+    elif weighting and precision == "compact":
+        # weightings are (255 - L) / 255 for each 8 bit luminance L, so this is exact
+        table = 255 - np.arange(256, dtype=np.uint8)
     elif weighting:
-        image = 1 - np.array(image.convert(mode="L").getdata()
-                             ).reshape((wheel_pixel_size, wheel_pixel_size)) / 255
+        table = (1 - np.arange(256) / 255).astype(np.float64 if precision == "double" else np.float32)
     else:
-        image = 255 - np.array(image.convert(mode="L").getdata()
-                               ).reshape((wheel_pixel_size, wheel_pixel_size))
+        table = 255 - np.arange(256, dtype=np.int64 if precision == "double" else np.int16)
+
+    # rows of the returned array are columns of the image (flipped), so it is converted a chunk of columns at
+    # a time, and only the final array is ever full size
+    shape = (wheel_pixel_size, wheel_pixel_size)
+    prepared = np.empty(shape, table.dtype) if scratch_dir is None else scratch_array(scratch_dir, shape, table.dtype)
+    mask = disk_mask(wheel_pixel_size)
+    for rows in chunks(wheel_pixel_size, max(1, 2 ** 22 // wheel_pixel_size)):
+        part = image.crop((rows.start, 0, rows.stop, wheel_pixel_size))
+        part = part.convert(mode="HSV").getchannel(1) if colour else part.convert(mode="L")
+        values = table[np.asarray(part)[::-1]].T
+        values[mask[::-1, rows].T] = 0
+        prepared[rows] = values
+    return prepared
+
+
+def parse_colour(colour):
+    """
+    RGB tuple of a colour given as a hex string, such as "ff0000" or "#ff0000".
+    """
+    colour = colour.lstrip("#")
+    if len(colour) != 6:
+        raise ValueError("Colour " + colour + " is not in hex format (e.g. ff0000)")
+    return tuple(int(colour[i:i+2], 16) for i in range(0, 6, 2))
 
-    coords = np.array(
-        list(product(range(wheel_pixel_size), range(wheel_pixel_size))))
-    x_coords = coords.T[0]
-    y_coords = coords.T[1]
-    coords_distance_from_centre = np.sqrt(
-        (x_coords - (wheel_pixel_size-1)*0.5)**2 + (y_coords - (wheel_pixel_size-1)*0.5)**2)
-    mask = np.array(coords_distance_from_centre > wheel_pixel_size*0.5)
-    mask = np.reshape(mask, (-1, wheel_pixel_size))
-    image[mask] = 0
 
-    return image.T[:, ::-1]
+def prepare_colour_layers(file_name, wheel_pixel_size, palette, precision="double"):
+    """
+    Decomposes a colour image into one image per thread colour of 'palette' (a list of RGB tuples), in the
+    same format as 'prepare_image': 255 where a thread of that colour is needed, and 0 where it is not.
+    Every pixel is assigned either to its closest palette colour or to the white background, with
+    Floyd-Steinberg dithering, so colours that are not in the palette become mixes of the closest ones.
+    """
+    colours = [(255, 255, 255)] + list(palette)
+    palette_image = Image.new("P", (1, 1))
+    # unused palette entries repeat the background
+    palette_image.putpalette([value for colour in colours for value in colour] +
+                             list(colours[0]) * (256 - len(colours)))
+    assignments = np.asarray(load_image(file_name, wheel_pixel_size).convert(mode="RGB").quantize(
+        palette=palette_image, dither=Image.FLOYDSTEINBERG))
+
+    mask = disk_mask(wheel_pixel_size)
+    layers = []
+    for index in range(1, len(colours)):
+        layer = np.where(assignments == index, 255, 0).astype(np.int64 if precision == "double" else np.int16)
+        layer[mask] = 0
+        layers.append(layer.T[:, ::-1])
+    return layers
+
+
+def weight_values(weights, pixels=None):
+    """
+    Values of a weighted image at the given linear pixels (or all of them), between 0 and 1, as float64.
+    Lower precision weightings (see 'prepare_image') are only gathered in their own dtype, so penalties are
+    always accumulated in float64. Weightings quantized to uint8 are converted back exactly.
+    """
+    if weights is None:
+        return None
+    values = weights if pixels is None else np.take(weights, pixels)
+    if values.dtype == np.uint8:
+        # same expression as in 'prepare_image', so values are identical to "double" precision
+        return 1 - (255 - values.astype(np.float64)) / 255
+    return values.astype(np.float64, copy=False)
 
 
-def save_plot(list_coloured_lines, list_colours, file_name, size, n_hooks):
+@lru_cache(maxsize=8)
+def disk_mask(wheel_pixel_size):
     """
-    Saves the plot of lines as a jpeg with a specified name.
-    It can also save multicoloured images; colours are added in the order they appear in the list.
-    The colour tuples are interpreted using RGB format.
+    Boolean square array which is True for the pixels outside the wheel circle (the ones 'prepare_image' zeros).
+    It is cached per size, and read-only.
+    """
+    coords = np.arange(wheel_pixel_size) - (wheel_pixel_size-1)*0.5
+    # a chunk of rows at a time, so very large wheels do not need full size float arrays
+    mask = np.empty((wheel_pixel_size, wheel_pixel_size), dtype=bool)
+    for rows in chunks(wheel_pixel_size, max(1, 2 ** 20 // wheel_pixel_size)):
+        mask[rows] = np.sqrt(coords[rows, None]**2 + coords[None, :]**2) > wheel_pixel_size*0.5
+    mask.flags.writeable = False
+    return mask
+
+
+def disk_pixels(wheel_pixel_size):
+    """
+    Linear indices of the pixels inside the wheel circle, in order. Maps packed images to square ones.
+    """
+    return np.flatnonzero(~disk_mask(wheel_pixel_size)).astype(np.int32)
+
+
+def pack_disk(image, disk, scratch_dir=None):
+    """
+    Keeps only the pixels of a square image that are inside the wheel circle, as a 1D array.
+    If 'scratch_dir' is given, the array is a scratch array (see 'scratch_array'), written a chunk at a time.
+    """
+    if scratch_dir is None:
+        return np.asarray(image).reshape(-1)[disk]
+    image = np.asarray(image).reshape(-1)
+    packed = scratch_array(scratch_dir, disk.shape, image.dtype)
+    for chunk in chunks(len(disk)):
+        packed[chunk] = image[disk[chunk]]
+    return packed
+
+
+def unpack_disk(packed_image, disk, wheel_pixel_size):
+    """
+    Square image (with zeros outside the wheel circle) from an image packed with 'pack_disk', e.g. for rendering.
+    """
+    image = np.zeros(wheel_pixel_size ** 2, dtype=packed_image.dtype)
+    image[disk] = packed_image
+    return image.reshape((wheel_pixel_size, wheel_pixel_size))
+
+
+# numbers the scratch files of this process
+_scratch_files = itertools.count()
+
+
+def scratch_array(scratch_dir, shape, dtype):
+    """
+    Writable array of zeros memory-mapped from a new file in 'scratch_dir', for arrays too large to keep in memory:
+    only the parts being used are loaded (into the OS page cache, which can drop them again under memory pressure).
+    The file is deleted right away where the OS allows it, and its space is freed along with the array.
+    """
+    os.makedirs(scratch_dir, exist_ok=True)
+    file_name = os.path.join(scratch_dir, f"scratch{os.getpid()}_{next(_scratch_files)}.npy")
+    array = np.lib.format.open_memmap(file_name, mode="w+", dtype=dtype, shape=shape)
+    try:
+        os.remove(file_name)
+    except OSError:
+        # e.g. on Windows, where files in use cannot be deleted
+        pass
+    return array
+
+
+def to_scratch(array, scratch_dir):
+    """
+    Copy of an array into a scratch array (see 'scratch_array'), a chunk at a time.
+    """
+    copy = scratch_array(scratch_dir, array.shape, array.dtype)
+    for rows in chunks(len(array), max(1, 2 ** 22 * len(array) // max(1, array.size))):
+        copy[rows] = array[rows]
+    return copy
+
+
+def chunks(n, size=2 ** 22):
+    """
+    Slices splitting range(n) into consecutive chunks of 'size', to go through large arrays a part at a time.
+    """
+    return [slice(start, min(n, start + size)) for start in range(0, n, size)]
+
+
+def plot_hooks(n_hooks, size):
+    """
+    Positions of the hooks in a plot, where the y axis points down.
     """
     new_hooks = generate_hooks(n_hooks, size)
 
     for i in range(len(new_hooks)):
         new_hooks[i] = [new_hooks[i][0], size - new_hooks[i][1]]
 
+    return new_hooks
+
+
+def save_plot(list_coloured_lines, list_colours, file_name, size, n_hooks):
+    """
+    Saves the plot of lines as a jpeg with a specified name.
+    It can also save multicoloured images; colours are added in the order they appear in the list.
+    The colour tuples are interpreted using RGB format.
+    """
+    new_hooks = plot_hooks(n_hooks, size)
+
     thread_image = Image.new('RGB', (size, size), (255, 255, 255))
     draw = ImageDraw.Draw(thread_image)
 
@@ -143,25 +539,72 @@ def save_plot(list_coloured_lines, list_colours, file_name, size, n_hooks):
     thread_image.save(file_name + ".jpg", format="JPEG")
 
 
-def save_plot_progress(list_coloured_lines, list_colours, file_name, size, n_hooks, proportion_list):
+def save_plot_progress(list_coloured_lines, list_colours, file_name, size, n_hooks, proportion_list,
+                       output_format="jpg", workers=4, frame_duration=200, together=False, animation_size=800):
     """
     Saves multiple plots midway through the construction process.
     'proportion_list' contains a list of floats between 0 and 1, representing the proportion of lines you want to 
     draw (e.g. if the list was [0.5,1], then 2 plots would be saved, one with half the lines drawn and one 
     completely finished.
+    All layers but the last are drawn fully first, unless 'together' is True, in which case every layer is drawn
+    up to each proportion, as when colours are threaded at the same time.
+    Lines are drawn only once, onto a single canvas, which is copied at each proportion. Frames are encoded
+    and written by a pool of 'workers' threads while drawing continues, with at most 'workers' more frames
+    waiting, so drawing never gets far ahead of the writes (each frame is a full size RGB image).
+    'output_format' is "jpg" for one "<file_name> <percentage>%.jpg" per proportion, "frames" for a numbered
+    "<file_name>_<number>.jpg" sequence, or "gif"/"webp" for a single animated "<file_name>_progress" file
+    (showing each frame for 'frame_duration' milliseconds). Animations need every frame in memory until they
+    are written, so their frames are scaled down to at most 'animation_size' pixels.
     """
-    for prop in proportion_list:
-        file_name_temp = f"{file_name} {int(100*prop)}%"
-        lines_temp = list_coloured_lines[-1][:int(
-            len(list_coloured_lines[-1])*prop)]
-        list_coloured_lines_temp = list_coloured_lines[:-1] + [lines_temp]
-        save_plot(list_coloured_lines_temp, list_colours,
-                  file_name_temp, size, n_hooks)
+    new_hooks = plot_hooks(n_hooks, size)
+
+    thread_image = Image.new('RGB', (size, size), (255, 255, 255))
+    draw = ImageDraw.Draw(thread_image)
+
+    # otherwise, all layers but the last are always fully drawn
+    progress_layers = list(range(len(list_coloured_lines))) if together else [len(list_coloured_lines) - 1]
+    for layer, (lines, colour) in enumerate(zip(list_coloured_lines, list_colours)):
+        if layer not in progress_layers:
+            for n in lines:
+                draw.line((tuple(new_hooks[n[0]]), tuple(new_hooks[n[1]])), fill=colour)
+
+    lines_drawn = [0] * len(list_coloured_lines)
+    animation_frames = []
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        saves = deque()
+        for frame, prop in enumerate(sorted(proportion_list)):
+            for layer in progress_layers:
+                lines = list_coloured_lines[layer]
+                for n in lines[lines_drawn[layer]:int(len(lines)*prop)]:
+                    draw.line((tuple(new_hooks[n[0]]), tuple(new_hooks[n[1]])), fill=list_colours[layer])
+                lines_drawn[layer] = max(lines_drawn[layer], int(len(lines)*prop))
+
+            if output_format == "jpg":
+                saves.append(executor.submit(thread_image.copy().save, f"{file_name} {int(100*prop)}%.jpg",
+                                             format="JPEG"))
+            elif output_format == "frames":
+                saves.append(executor.submit(thread_image.copy().save, f"{file_name}_{frame:04d}.jpg",
+                                             format="JPEG"))
+            elif size > animation_size:
+                animation_frames.append(thread_image.resize((animation_size, animation_size), Image.LANCZOS))
+            else:
+                animation_frames.append(thread_image.copy())
+            if len(saves) > workers:
+                saves.popleft().result()
+
+        # surface any error from the background writes
+        for save in saves:
+            save.result()
+
+    if len(animation_frames) > 0:
+        animation_frames[0].save(f"{file_name}_progress.{output_format}", save_all=True,
+                                 append_images=animation_frames[1:], duration=frame_duration, loop=0)
 
 
 def total_distance(lines, hooks, wheel_diameter_m, wheel_pixel_size, out_file):
     """
-    Prints out the total distance of thread needed to make the model (in meters).
+    Prints out the total distance of thread needed to make the model (in meters), and returns it.
     """
     d = 0
     for line in lines:
@@ -175,6 +618,8 @@ def total_distance(lines, hooks, wheel_diameter_m, wheel_pixel_size, out_file):
     with open(out_file+".txt", 'w') as f:
         f.write(distance_str+'\n')
 
+    return d
+
 
 def display_output(lines, out_file):
     """
@@ -199,3 +644,115 @@ def file_path_invalid(file_path):
         print("File " + file_path + " not found")
         return True
     return False
+
+
+class Trace:
+    """
+    Structured record of a run, written as one JSON object per line into 'file_name':
+     "phase" events with the seconds spent in each phase (loading geometry, preparing images, precomputing
+        line constants, searching lines, rendering outputs), see 'phase';
+     "step" events every 'step_interval' lines drawn (if above 0), with the seconds spent, candidate lines
+        scored, pixels read and the best fitness of that step, see 'count' and 'step';
+     a "summary" event when closed, with the total time of every phase and the totals of every counter.
+    If 'profile' is True, the whole run is also profiled with cProfile into 'file_name'.prof, and if 'memory' is
+    True, phases also record the current and peak memory allocated (traced by tracemalloc, which is slow).
+    Without a trace, runs only check that it is None, so it costs nothing when disabled.
+    """
+
+    def __init__(self, file_name, step_interval=0, profile=False, memory=False):
+        self.file_name = file_name
+        self.step_interval = step_interval
+        self.memory = memory
+        # peak memory of every phase in progress, so phases can be nested
+        self.peaks = []
+        self.peak = 0
+        self.phases = {}
+        self.counters = {}
+        self.step_counters = {}
+        self.n_steps = 0
+        self.step_seconds = 0.0
+        self.file = open(file_name, 'w')
+        self.t0 = time.perf_counter()
+        if memory:
+            tracemalloc.start()
+        self.profiler = cProfile.Profile() if profile else None
+        if self.profiler is not None:
+            self.profiler.enable()
+
+    def write(self, event, **fields):
+        """
+        Writes an event, with the seconds since the trace started.
+        """
+        self.file.write(json.dumps(dict(event=event, t=round(time.perf_counter() - self.t0, 6), **fields)) + "\n")
+
+    @contextlib.contextmanager
+    def phase(self, name, **fields):
+        """
+        Context manager timing a phase of the run, written with 'fields' when it ends.
+        Phases can be nested, the time of inner phases is also counted in outer ones.
+        """
+        if self.memory:
+            if len(self.peaks) > 0:
+                self.peaks[-1] = max(self.peaks[-1], tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+            self.peaks.append(0)
+        t = time.perf_counter()
+        yield
+        seconds = time.perf_counter() - t
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+        if self.memory:
+            current, peak = tracemalloc.get_traced_memory()
+            peak = max(self.peaks.pop(), peak)
+            if len(self.peaks) > 0:
+                self.peaks[-1] = max(self.peaks[-1], peak)
+            self.peak = max(self.peak, peak)
+            fields = dict(fields, current_mb=round(current / 2 ** 20, 2), peak_mb=round(peak / 2 ** 20, 2))
+        self.write("phase", name=name, seconds=round(seconds, 6), **fields)
+
+    def count(self, name, value=1):
+        """
+        Adds 'value' to a counter of the current step.
+        """
+        self.step_counters[name] = self.step_counters.get(name, 0) + value
+
+    def step(self, index, seconds, **fields):
+        """
+        Ends a step (the line 'index' of a run), adding its counters to the totals, and writes it with 'fields'
+        if it is sampled.
+        """
+        self.n_steps += 1
+        self.step_seconds += seconds
+        for name, value in self.step_counters.items():
+            self.counters[name] = self.counters.get(name, 0) + value
+        if self.step_interval > 0 and index % self.step_interval == 0:
+            self.write("step", index=index, seconds=round(seconds, 6), **self.step_counters, **fields)
+        self.step_counters = {}
+
+    def close(self):
+        """
+        Writes the summary, and the profile if any, and closes the trace.
+        """
+        summary = {"phases": {name: round(seconds, 6) for name, seconds in self.phases.items()},
+                   "steps": self.n_steps, "step_seconds": round(self.step_seconds, 6), "counters": self.counters}
+        if self.profiler is not None:
+            self.profiler.disable()
+            self.profiler.dump_stats(self.file_name + ".prof")
+            summary["profile"] = self.file_name + ".prof"
+        if self.memory:
+            summary["peak_mb"] = round(max(self.peak, tracemalloc.get_traced_memory()[1]) / 2 ** 20, 2)
+            tracemalloc.stop()
+        self.write("summary", **summary)
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def trace_phase(trace, name, **fields):
+    """
+    Context manager timing a phase into 'trace' (see 'Trace.phase'), or doing nothing if 'trace' is None.
+    """
+    return contextlib.nullcontext() if trace is None else trace.phase(name, **fields)